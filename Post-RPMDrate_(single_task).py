@@ -46,45 +46,152 @@ V1.2:
 1) PMF: Plot range modified.
 '''
 import argparse
+import os
 parser = argparse.ArgumentParser()
 parser.description='please enter two parameters t for temperature n for number of beads...'
 parser.add_argument("-t", "--t", help="this is parameter t", dest="T", type=str, default="1000")
 parser.add_argument("-n", "--n", help="this is parameter n",dest="N",  type=str, default="64")
 parser.add_argument("-i", "--input", help="path of the input.py",dest="I",  type=str, default="input.py")
 parser.add_argument("-R", "--RPMDpath", help="this is parameter n",dest="R",  type=str, default="./")
-args = parser.parse_args()
-import os
-from mpl_toolkits.mplot3d import Axes3D
+parser.add_argument("--batch", help="process all the tasks RPMDpath/T/Nbeads, ignoring -t and -n", dest="batch", action="store_true")
+parser.add_argument("--tasks", help="number of tasks processed at the same time in batch mode", dest="tasks", type=int, default=os.cpu_count())
+parser.add_argument("-j", "--jobs", help="number of processes plotting the figures", dest="jobs", type=int, default=1)
+parser.add_argument("--frames", help="PMF figures to plot: all, none, every:k, log:n or last:n", dest="frames", type=str, default="all")
+parser.add_argument("--variances", help="plot the variance in each window into Variances/ (png) or Variances.pdf (pdf)", dest="variances", choices=["none", "png", "pdf"], default="none")
+parser.add_argument("--pmf-3d", help="plot the contour and 3D surface of the PMF evolution", dest="pmf3D", action="store_true")
+parser.add_argument("--pmf-text", help="also export the PMF evolution into the text file PMF_data.txt", dest="pmfText", action="store_true")
+parser.add_argument("--bins", help="number of bins of the PMF evolution, the barrier is refined between the bins", dest="bins", type=int, default=500)
+parser.add_argument("--shard", help="only compute the PMF evolution of the k-th of N ranges of cycles into PMF_shards/, e.g. 2/8", dest="shard", type=str, default=None)
+parser.add_argument("--merge", help="assemble the PMF evolution from the shards of --shard instead of computing it", dest="merge", action="store_true")
+parser.add_argument("--incremental", help="only rebuild the outputs whose inputs, parameters or code changed since the last run", dest="incremental", action="store_true")
+parser.add_argument("--profile", help="record the time and memory of each stage into profile.json and profile.csv", dest="profile", action="store_true")
+parser.add_argument("--watch", help="keep refreshing the figures while the umbrella sampling is running", dest="watch", action="store_true")
+parser.add_argument("--interval", help="seconds between two refreshes in watch mode", dest="interval", type=float, default=60.0)
+parser.add_argument("--no-cache", help="do not use the cache of umbrella data", dest="noCache", action="store_true")
+parser.add_argument("--io-threads", help="number of threads reading the umbrella files", dest="ioThreads", type=int, default=1)
+parser.add_argument("--compact", help="keep the umbrella data without padding, and plot from float32 copies", dest="compact", action="store_true")
+parser.add_argument("--upload", help="where to upload the figures and data: coscmd, local:DIR or none", dest="upload", type=str, default="coscmd")
+parser.add_argument("--upload-jobs", help="number of files uploaded at the same time", dest="uploadJobs", type=int, default=4)
+parser.add_argument("--upload-retries", help="number of retries of a failed upload", dest="uploadRetries", type=int, default=3)
+import ast
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import operator
+import platform
+import shutil
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import matplotlib
+matplotlib.use('Agg')  # figures are only saved, no display is needed
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
-from matplotlib import ticker
+from matplotlib import colors as mcolors, font_manager, ticker
+from matplotlib.collections import LineCollection
 import numpy as np
-import pandas as pd
-import scipy.special as scp
 color = ['#00447c', '#ae0d16', '#47872c', '#800964']
 # SHU Blue, Weichang Red, Willow Green, SHU Purple
 # This color scheme can be easily obtained on the official website `vi.shu.edu.cn`.
 Tcolor1 = [0., 68., 124.]
 Tcolor2 = [174., 13., 22.]
 
-def clearFolder(path):
-    if os.path.exists(os.path.join(figPath, path)):
-        for fileName in os.listdir(os.path.join(figPath, path)):
-            os.remove(os.path.join(figPath, path, fileName))
+def gradientColor(length):
+    """
+    Transition colors of `length` windows, from blue (xi = 0) to red (xi = 1).
+    """
+    i = np.arange(length)
+    return np.column_stack((np.floor(255. * i / length) / 255.0,
+                            np.zeros(length),
+                            np.floor(-255. * i / length + 255) / 255.0))
+
+
+# The attributes of a task needed by the plotting functions in the worker processes. `umbInfo` goes through shared
+# memory.
+sharedState = ['args', 'xi_list', 'kforce_list', 'temp', 'delta', 'Nbeads', 'inputFile', 'Ntraj', 'NtrajEff',
+               'timeSep', 'figPath', 'path', 'mylabel', 'myticks', 'umbLengths', 'umbOffsets']
+
+
+class TaskState:
+    """
+    The state of one task: its options `args`, its input, its umbrella data and the bookkeeping of its outputs.
+    The functions working on a task take it as their first argument, so that several tasks can be processed
+    in the same process.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.figPath = self.path = self.inputFile = None
+        self.temp = self.Nbeads = self.delta = None
+        self.xi_list = self.kforce_list = None
+        self.mylabel, self.myticks = None, []
+        self.Ntraj = self.NtrajEff = self.timeSep = None
+        self.umbInfo = None
+        self.umbLengths = None  # number of lines of each window with `--compact`, otherwise None
+        self.umbOffsets = None  # where each window starts in the ragged `umbInfo` with `--compact`
+        self.buildState = {}  # the signature and the outputs of each job at its last run, kept in `build_state.json`
+        self.profileRecords = []  # the timing of each stage with `--profile`
+        self.savefigTime = [0., 0.]  # the wall and CPU time spent in savefig by the running stage
+        self.savedFiles = []  # outputs of the running job
+        self.uploadPool = None
+        self.uploadFutures = {}  # the upload of each file, by its name in the manifest
+        self.uploadPrefix = {}  # the prefix of the keys of the figure (fig) and data (data) folders
+        self.uploadManifest = {}  # the files of the last run, kept in `upload_manifest.json`
+
+    def shared(self):
+        """
+        A copy of the attributes of `sharedState`, to be sent to the worker processes.
+        """
+        state = TaskState(self.args)
+        for name in sharedState:
+            setattr(state, name, getattr(self, name))
+        return state
+
+
+def clearFolder(state, path):
+    if os.path.exists(os.path.join(state.figPath, path)):
+        for fileName in os.listdir(os.path.join(state.figPath, path)):
+            os.remove(os.path.join(state.figPath, path, fileName))
     else:
-        os.makedirs(os.path.join(figPath, path))
+        os.makedirs(os.path.join(state.figPath, path))
 
 
-def plot_parameters(title, width=4):
-    print('[INFO] Plotting {}! '.format(title))
-    plt.figure(figsize=(width, 3))
-    plt.rcParams["font.family"] = "Times New Roman"
+styleReady = False
+
+
+def setupStyle():
+    """
+    Set the rcParams of all figures, once per process.
+    """
+    global styleReady
+    if styleReady:
+        return
+    try:
+        font_manager.findfont("Times New Roman", fallback_to_default=False)
+        plt.rcParams["font.family"] = "Times New Roman"
+    except ValueError:
+        print('[WARNING] Font Times New Roman not found, the default font will be used. ')
     plt.rcParams["mathtext.fontset"] = "stix"  # The font closet to Times New Roman
     plt.rcParams['xtick.direction'] = 'in'
     plt.rcParams['ytick.direction'] = 'in'
     plt.rcParams['ytick.right'] = True
     plt.rcParams['ytick.left'] = True
     plt.rcParams['xtick.top'] = True
+    styleReady = True
+
+
+def plot_parameters(title, width=4):
+    print('[INFO] Plotting {}! '.format(title))
+    setupStyle()
+    plt.figure(figsize=(width, 3))
     plt.minorticks_on()  # Turn on minor ticks
 
     file = '{}.png'.format(title)
@@ -92,9 +199,18 @@ def plot_parameters(title, width=4):
         os.remove(file)
 
 
-def plot_save(name):
+def outputPath(state, name):
+    """
+    The path of the output `name` in the figure folder, recorded as an output of the running job.
+    """
+    state.savedFiles.append(name)
+    return os.path.join(state.figPath, name)
+
+
+def plot_save(state, name):
     plt.tight_layout()
-    plt.savefig(os.path.join(figPath, name + '.png'), format='png', dpi=600)  # .svg is recommended!
+    with savefigTimer(state):
+        plt.savefig(outputPath(state, name + '.png'), format='png', dpi=600)  # .svg is recommended!
     plt.clf()
     plt.close()
 
@@ -105,82 +221,97 @@ def myFormatter():
     sciFormatter.set_powerlimits((-1, 1))
     return sciFormatter
 
+def plot_lines(x, y, colors, lw, alpha):
+    """
+    Draw the curves y[:, i] against x[:, i] (or a shared x) of all windows as one LineCollection.
+    `colors`, `lw` and `alpha` are one value for all the curves or one per curve.
+    """
+    y = np.asarray(y)
+    x = np.broadcast_to(np.reshape(x, (len(x), -1)), y.shape)
+    segments = np.stack((x, y), axis=-1).transpose(1, 0, 2)  # (curves, points, xy)
+    rgba = np.array(np.broadcast_to(mcolors.to_rgba_array(colors), (y.shape[1], 4)))
+    rgba[:, 3] = alpha
+    ax = plt.gca()
+    ax.add_collection(LineCollection(segments, colors=rgba, linewidths=lw))
+    ax.autoscale_view()
+
+
 def my_gaussian(x, xav, xav2):
     y = (1.0 / (np.sqrt(2.0 * np.pi * xav2))) * np.exp(-(x - xav) ** 2 / (2.0 * xav2))
     return y
 
 def overlapArea(a1, v1, a2, v2):
+    """
+    The overlap area of the Gaussian functions of means `a1`, `a2` and variances `v1`, `v2`.
+    Arrays are computed element-wise.
+    """
+    import scipy.special as scp
+
     eps = 1E-15
+    a1, v1, a2, v2 = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (a1, v1, a2, v2)])
     # variance 2 > 1
-    if abs(v1 - v2) > eps:
-        if v1 > v2:
-            a1, a2 = a2, a1
-            v1, v2 = v2, v1
+    swap = v1 > v2
+    a1, a2 = np.where(swap, a2, a1), np.where(swap, a1, a2)
+    v1, v2 = np.where(swap, v2, v1), np.where(swap, v1, v2)
+    equal = np.abs(v1 - v2) <= eps
 
+    with np.errstate(divide='ignore', invalid='ignore'):
         delta = (a1 - a2) * (a1 - a2) + (v1 - v2) * np.log(v1 / v2)
         delta = delta * v1 * v2
         delta = np.sqrt(delta)
         bb = a2 * v1 - a1 * v2
         c1 = (bb + delta) / (v1 - v2)
         c2 = (bb - delta) / (v1 - v2)
-        assert c1 < c2, "Check the solution of overlapping Gaussian function! "
-        # print(c1, c2)
+        assert not np.any((c1 >= c2) & ~equal), "Check the solution of overlapping Gaussian function! "
 
         S1 = scp.erf((a1 - c1) / np.sqrt(2.0 * v1)) - 1
         S2 = scp.erf((a2 - c2) / np.sqrt(2.0 * v2)) - scp.erf((a2 - c1) / np.sqrt(2.0 * v2))
         S3 = -1 - scp.erf((a1 - c2) / np.sqrt(2.0 * v1))
+        S = (S1 + S2 + S3) / (-2.0)
 
-        S = S1 + S2 + S3
-        S = S / (-2.0)
-    else:
-        if a1 > a2:
-            a1, a2 = a2, a1
-
-        c = (a1 + a2) / 2.0
-        # print(c)
-        S = scp.erf((a2 - c) / np.sqrt(2.0 * v1)) - 1
-        S = S * 2 / (-2.0)
+    # equal variances
+    c = (a1 + a2) / 2.0
+    Seq = scp.erf((np.maximum(a1, a2) - c) / np.sqrt(2.0 * v1)) - 1
+    Seq = Seq * 2 / (-2.0)
 
-    assert S <= 1, "The overlap could never more than 1! "
+    S = np.where(equal, Seq, S)
+    assert not np.any(S > 1), "The overlap could never more than 1! "
     return S
 
-def plot_overlap():
+
+def plot_overlap(state):
     title = 'Overlap'
     plot_parameters(title, width=9)
 
     resolution = 2000
     extend = 0.03  # 3E-2
 
-    xiMin = np.min(xi_list)
-    xiMax = np.max(xi_list)
-    length = len(xi_list)
+    xiMin = np.min(state.xi_list)
+    xiMax = np.max(state.xi_list)
+    length = len(state.xi_list)
 
     x_new = np.linspace(xiMin - extend, xiMax + extend, resolution)
     y_sum = np.zeros((resolution))  # Total density line
 
-    maxPop = 0  # maximum of the summation of all population
+    xav, xav2 = umbColumn(state, 3, state.NtrajEff - 1), umbColumn(state, 4, state.NtrajEff - 1)
+    zero = xav2 < 1E-10  # xav2 is zero!
+    various = xav2 > 1.0E-4
     for i in range(length):
-        # Gaussian smearing
-        xav, xav2 = umbInfo[3:, NtrajEff - 1, i]
-        if xav2 < 1E-10:  # xav2 is zero!
-            plt.axvline(xi_list[i], ls='--', c='red', lw=0.2)
-            print('[ERROR] Variance at `xi = {}` is ZERO! '.format(xi_list[i]))
-        else:
-            y_new = my_gaussian(x_new, xav, xav2)
-
-            # Find biggest population
-            if max(y_new) > maxPop:
-                maxPop = max(y_new)
-
-            y_sum += y_new  # sum all population
-            if xav2 > 1.0E-4:
-                print("[WARNING] May be too various in xi = {}! ".format(xi_list[i]))
-                plt.plot(x_new, y_new, lw=1, c=color[1], alpha=0.8)
-            else:
-                plt.plot(x_new, y_new, lw=0.5, c=color[0], alpha=.3)
+        if zero[i]:
+            plt.axvline(state.xi_list[i], ls='--', c='red', lw=0.2)
+            print('[ERROR] Variance at `xi = {}` is ZERO! '.format(state.xi_list[i]))
+        elif various[i]:
+            print("[WARNING] May be too various in xi = {}! ".format(state.xi_list[i]))
+
+    # Gaussian smearing
+    y_new = my_gaussian(x_new[:, np.newaxis], xav[~zero], xav2[~zero])
+    y_sum += np.sum(y_new, axis=1)  # sum all population
+    various = various[~zero]
+    plot_lines(x_new, y_new, np.where(various, color[1], color[0]),
+               lw=np.where(various, 1, 0.5), alpha=np.where(various, 0.8, .3))
 
     # Plot summation and difference
-    plt.plot(x_new, y_sum, lw=1, c=color[0], label=mylabel)  # label='Summation of all populations')  # SHU Blue
+    plt.plot(x_new, y_sum, lw=1, c=color[0], label=state.mylabel)  # label='Summation of all populations')  # SHU Blue
 
     plt.xlabel('Reaction Coordinate')
     plt.ylabel('Population')
@@ -194,96 +325,112 @@ def plot_overlap():
     plt.legend(loc='upper left')
 
     # overlap ratio
-    xbar = umbInfo[3, NtrajEff - 1, :]
-    xvar = umbInfo[4, NtrajEff - 1, :]
+    xbar = umbColumn(state, 3, state.NtrajEff - 1)
+    xvar = umbColumn(state, 4, state.NtrajEff - 1)
     # overlapList = (xi_list[:-1] + xi_list[1:]) / 2
     overlapList = (xbar[:-1] + xbar[1:]) / 2
-    overlapRatio = np.zeros(length - 1)
-    for i in range(length - 1):
-        overlapRatio[i] = overlapArea(xbar[i], xvar[i], xbar[i + 1], xvar[i + 1])
-
-        if overlapRatio[i] > 0.99:
-            print('[WARN] Windows coincide! Check `{}` and `{}`! '.format(xi_list[i], xi_list[i + 1]))
-        # continue
+    overlapRatio = overlapArea(xbar[:-1], xvar[:-1], xbar[1:], xvar[1:])
+    for i in np.flatnonzero(overlapRatio > 0.99):
+        print('[WARN] Windows coincide! Check `{}` and `{}`! '.format(state.xi_list[i], state.xi_list[i + 1]))
 
     plotRatio = plt.twinx()
     plotRatio.plot(overlapList, overlapRatio, 'o-', c=color[1], markersize=2, lw=0.5)
     plotRatio.axis(ymin=0, ymax=1)
 
-    plot_save(title)
+    plot_save(state, title)
+
+
+def overlapEvolution(state):
+    """
+    The overlap ratio of adjacent windows at every cycle, of shape (cycles, window pairs).
+    """
+    xbar = umbColumn(state, 3, slice(state.NtrajEff))
+    xvar = umbColumn(state, 4, slice(state.NtrajEff))
+    return overlapArea(xbar[:, :-1], xvar[:, :-1], xbar[:, 1:], xvar[:, 1:])
+
+
+def plot_overlap_evolution(state):
+    """
+    The overlap ratio of adjacent windows at every cycle, as a heatmap and a (cycles, window pairs) array
+    saved in `overlap_evolution.npy`.
+    """
+    title = 'Overlap_evolution'
+    plot_parameters(title, width=9)
+
+    overlapRatio = overlapEvolution(state)
+    np.save(outputPath(state, 'overlap_evolution.npy'), overlapRatio)
+
+    timeEvolution = umbColumn(state, 2, slice(state.NtrajEff))[:, 0] * state.delta
+    overlapList = (state.xi_list[:-1] + state.xi_list[1:]) / 2
+    plt.pcolormesh(timeEvolution, overlapList, overlapRatio.T, cmap='Greens', vmin=0, vmax=1, shading='nearest')
+    plt.colorbar(label='Overlap')
+
+    plt.xlabel('Time (ps)')
+    plt.ylabel('Reaction Coordinate')
 
+    plot_save(state, title)
 
-def plot_variance():
-    if NtrajEff == 1:
+
+def blockStatistics(state):
+    """
+    The mean and variance of xi over each block of samples between two lines of the umbrella files,
+    recovered from the cumulative columns of `umbInfo` for all windows at once,
+    and the ratio of the block variance to the cumulative variance. Arrays of shape (Ntraj, Nwindows).
+    The recovery is always done in float64, with `--compact` on the ragged data and the results are float32.
+    """
+    if state.umbLengths is None:
+        av, av2, count = np.diff(state.umbInfo[:3], axis=1, prepend=0.)
+        cumulativeVariance = state.umbInfo[4]
+    else:
+        blocks = np.diff(state.umbInfo[:, :3], axis=0, prepend=np.zeros((1, 3)))
+        starts = state.umbOffsets[:-1][state.umbLengths > 0]
+        blocks[starts] = state.umbInfo[starts, :3]  # the first block of each window
+        av, av2, count = blocks.T
+        cumulativeVariance = state.umbInfo[:, 4]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = av / count
+        variance = av2 / count - mean * mean
+        jumpRatio = variance / cumulativeVariance
+    if state.umbLengths is None:
+        return mean, variance, jumpRatio
+    return tuple(raggedToDense(state, x, dtype=np.float32) for x in (mean, variance, jumpRatio))
+
+
+def plot_variance(state):
+    if state.NtrajEff == 1:
         return
 
     title = 'Variance'
     plot_parameters(title)
 
-    xiMin = np.min(xi_list)
-    xiMax = np.max(xi_list)
-    length = len(xi_list)
+    xiMin = np.min(state.xi_list)
+    xiMax = np.max(state.xi_list)
+    length = len(state.xi_list)
 
-    timeMax = 0.0
-    timeMin = 1E5
-    jumpCount = 0
+    # large jump: the variance of a block is more than twice the cumulative one
+    mean, variance, jumpRatio = blockStatistics(state)
+    xivar = umbColumn(state, 4, dtype=np.float32)
+    stepCount = umbColumn(state, 2, dtype=np.float32)
+    jumps = np.argwhere(jumpRatio[1:].T - 1 > 1)
+    if len(jumps) > 0:
+        print('[INFO] Large jump: xi, step/10000, Current var, var')
+    for i, j in jumps:
+        print('{:.3f}\t{:>5d}\t{:.3e}\t{:.3e}'.format(state.xi_list[i], int(stepCount[j + 1, i] / 10000),
+                                                      variance[j + 1, i], xivar[j + 1, i]))
 
-    for i in range(length):
-        xivar = umbInfo[4, :, i]
-        timeEvolution = umbInfo[2, :, i]
-
-        timeStep = delta
-        timeEvolution = [x * timeStep for x in timeEvolution]  # 0.1 fs to 1 ns
-
-        if xivar[-1] > 5E-5:
-            print('       traj. at xi = {} may be too various! '.format(xi_list[i]))
-
-        # largeJumpJudge = np.var(xivar)*1E13
-        # if largeJumpJudge > 10:
-        #     print('{:.3f}\t{:.2f}'.format(xi_list[i], largeJumpJudge))
-
-        for j in range(len(xivar)):
-            if j > 0:
-                varCurrent = (umbInfo[1, j, i] - umbInfo[1, j - 1, i]) / (umbInfo[2, j, i] - umbInfo[2, j - 1, i]) - \
-                             ((umbInfo[0, j, i] - umbInfo[0, j - 1, i]) / (
-                                         umbInfo[2, j, i] - umbInfo[2, j - 1, i])) ** 2
-                if varCurrent / umbInfo[4, j, i] - 1 > 1:
-                    if jumpCount == 0:
-                        print('[INFO] Large jump: xi, step/10000, Current var, var')
-                    print('{:.3f}\t{:>5d}\t{:.3e}\t{:.3e}'.format(xi_list[i], int(umbInfo[2, j, i] / 10000),
-                                                                  varCurrent, umbInfo[4, j, i]))
-                    jumpCount += 1
-
-        # xivarDelta = []
-        # for i in range(len(xivar)-1):
-        #     xivarDelta.append(np.abs(xivar[i+1] - xivar[i]))
-        # x = range(len(xivar))
-        # plt.yscale('log')
-
-        # # Shifted
-        # for i in range(len(xivar)):
-        #     xivar[i] = xivar[i] - xivar[0]
-
-        # define transition color # from SHU blue (xi = 0) to Weichang red (xi = 1)
-        # tscolor = (int(((Tcolor2[0] - Tcolor1[0]) * i / length + 0)) / 255.0,
-        #            (int((Tcolor2[1] - Tcolor1[1]) * i / length + 68)) / 255.0,
-        #            (int((Tcolor2[2] - Tcolor1[2]) * i / length + 124)) / 255.0)
-        tscolor = (int((255. * i / length)) / 255.0,
-                   0.,
-                   (int(-255. * i / length + 255)) / 255.0)
-        # colorList = list(tscolor)
-        # colorPrint = []
-        # for j in range(3):
-        #     colorPrint.append(int(colorList[j] * 255))
-        # print('{:.3f}\t{:}'.format(xi_list[i], colorPrint))
-
-        # color = (np.random.rand(), np.random.rand(), np.random.rand())
-        plt.plot(timeEvolution, xivar, lw=1, c=tscolor, alpha=0.5)
-
-        if max(timeEvolution) > timeMax:
-            timeMax = max(timeEvolution)
-        if min(timeEvolution) < timeMin:
-            timeMin = min(timeEvolution)
+    timeEvolution = stepCount * state.delta  # 0.1 fs to 1 ns
+    for i in np.flatnonzero(xivar[-1] > 5E-5):
+        print('       traj. at xi = {} may be too various! '.format(state.xi_list[i]))
+
+    # largeJumpJudge = np.var(xivar)*1E13
+    # if largeJumpJudge > 10:
+    #     print('{:.3f}\t{:.2f}'.format(xi_list[i], largeJumpJudge))
+
+    # define transition color # from blue (xi = 0) to red (xi = 1)
+    plot_lines(timeEvolution, xivar, gradientColor(length), lw=1, alpha=0.5)
+
+    timeMax = np.nanmax(timeEvolution)
+    timeMin = np.nanmin(timeEvolution)
 
     plt.xlabel('Time (ps)')
     plt.ylabel('Variance')
@@ -299,58 +446,28 @@ def plot_variance():
     formatter.set_powerlimits((-1, 1))
     plt.gca().yaxis.set_major_formatter(formatter)
 
-    plot_save(title)
+    plot_save(state, title)
 
 
-def plot_variance_diff():
-    if NtrajEff == 1:
+def plot_variance_diff(state):
+    if state.NtrajEff == 1:
         return
 
     title = 'Variance_diff'
     plot_parameters(title)
 
-    xiMin = np.min(xi_list)
-    xiMax = np.max(xi_list)
-    length = len(xi_list)
-
-    timeMax = 0.0
-    timeMin = 1E5
-    jumpCount = 0
+    xiMin = np.min(state.xi_list)
+    xiMax = np.max(state.xi_list)
+    length = len(state.xi_list)
 
-    v = []
+    mean, variance, jumpRatio = blockStatistics(state)
+    v = [variance[:, i] for i in range(length)]
 
-    for i in range(length):
-        av = umbInfo[0, :, i]
-        av2 = umbInfo[1, :, i]
-        timeEvolution = umbInfo[2, :, i]
-
-        Nsample = len(av)
-        variance = np.zeros(Nsample)
-        for j in range(Nsample):
-            if j == 0:
-                dmean = av[0] / timeEvolution[0]
-                variance[0] = av2[0] / timeEvolution[0] - dmean * dmean
-            else:
-                dt = timeEvolution[j] - timeEvolution[j-1]
-                dmean = (av[j] - av[j-1])  / dt
-                variance[j] = (av2[j] - av2[j-1]) / dt - dmean * dmean
-                # print(i, xi_list[i], variance[j], dt, dmean, av[j], av2[j])
-
-        v.append(variance)
-
-        tscolor = (int((255. * i / length)) / 255.0,
-                   0.,
-                   (int(-255. * i / length + 255)) / 255.0)
+    timeEvolution = umbColumn(state, 2, dtype=np.float32) * state.delta  # 0.1 fs to 1 ns
+    plot_lines(timeEvolution, variance, gradientColor(length), lw=0.2, alpha=0.4)
 
-        timeStep = delta
-        timeEvolution = [x * timeStep for x in timeEvolution]  # 0.1 fs to 1 ns
-
-        plt.plot(timeEvolution, variance, lw=0.2, c=tscolor, alpha=0.4)
-
-        if max(timeEvolution) > timeMax:
-            timeMax = max(timeEvolution)
-        if min(timeEvolution) < timeMin:
-            timeMin = min(timeEvolution)
+    timeMax = np.nanmax(timeEvolution)
+    timeMin = np.nanmin(timeEvolution)
 
     plt.xlabel('Time (ps)')
     plt.ylabel('Variance')
@@ -366,13 +483,13 @@ def plot_variance_diff():
     formatter.set_powerlimits((-1, 1))
     plt.gca().yaxis.set_major_formatter(formatter)
 
-    plot_save(title)
+    plot_save(state, title)
 
     title = 'Variance_diff_box'
     plot_parameters(title, width=8)
     for i in range(len(v)):
-        v[i] = np.multiply(v[i], kforce_list[i])
-    plt.boxplot(v, positions=xi_list, widths=0.003, labels=None,
+        v[i] = np.multiply(v[i], state.kforce_list[i])
+    plt.boxplot(v, positions=state.xi_list, widths=0.003, labels=None,
                 whiskerprops={'lw': 0.5},
                 capprops={'lw':0.5},
                 medianprops={'lw':1, 'color': color[1]}, # mean line
@@ -391,149 +508,147 @@ def plot_variance_diff():
     formatter.set_powerlimits((-1, 1))
     plt.gca().yaxis.set_major_formatter(formatter)
 
-    plot_save(title)
+    plot_save(state, title)
 
     return
 
 
-def plot_var_evolution():
-    if NtrajEff == 1:
+def plot_var_evolution(state, fmt='png'):
+    """
+    Plot the evolution of the mean and the variance of xi in each window,
+    as PNG files in `Variances/`, or as the pages of `Variances.pdf` if `fmt` is 'pdf'.
+    The figure is built once, only the data and the axis limits change from one window to the next.
+    """
+    if state.NtrajEff == 1:
         return
 
     title = 'Variance in each windows'
-    clearFolder('Variances')
-    plot_parameters(title)
-    formatter = ticker.ScalarFormatter(useMathText=True)
-    formatter.set_scientific(True)
-    formatter.set_powerlimits((-1, 1))
-
-    xiMin = np.min(xi_list)
-    xiMax = np.max(xi_list)
-    length = len(xi_list)
-
-    timeMax = np.max(umbInfo[2, :, :]) * 1E-3 * delta
+    print('[INFO] Plotting {}! '.format(title))
+    setupStyle()
+
+    length = len(state.xi_list)
+    blockMean, blockVariance, jumpRatio = blockStatistics(state)
+    cumulativeMean = umbColumn(state, 0, dtype=np.float32) / umbColumn(state, 2, dtype=np.float32)
+    cumulativeVariance = umbColumn(state, 4, dtype=np.float32)
+    stepCounts = umbColumn(state, 2, dtype=np.float32)
+    firstMean = umbColumn(state, 3, 0)
+
+    fig = plt.figure()
+    gs = gridspec.GridSpec(2, 2)
+
+    me = fig.add_subplot(gs[0, 0])  # mean evolution
+    ms = fig.add_subplot(gs[0, 1])  # mean scatter
+    ee = fig.add_subplot(gs[1, 0])  # each evolution
+    es = fig.add_subplot(gs[1, 1])  # each scatter
+
+    # mean evolution
+    meLine, = me.plot([], [], c=color[0])
+    me.yaxis.set_major_formatter(myFormatter())
+    me_var = me.twinx()
+    me_varLine, = me_var.plot([], [], c=color[1])
+    me_var.yaxis.set_major_formatter(myFormatter())
+    me.axhline(y=0.0, c='black', ls='--', lw=1)  # xi_ref
+    # axis label
+    me.set_xlabel('Time (ps)')
+    me.tick_params('y', colors=color[0])
+    me.set_ylabel('$\\xi - \\xi_{{\mathrm{{ref}}}}$', color=color[0])
+    me_var.tick_params('y', colors=color[1])
+    me_var.set_ylabel('Variance', color=color[1])
+
+    # mean scatter
+    msLine, = ms.plot([], [], c=color[0], marker='o', ls='', markersize=1)
+    ms.yaxis.set_major_formatter(myFormatter())
+    ms.xaxis.set_major_formatter(myFormatter())
+    ms.axvline(x=0.0, c='black', ls='--', lw=1)  # xi_ref
+    ms.set_ylabel('Variance')
+    ms.set_xlabel('$\\xi - \\xi_{{\mathrm{{ref}}}}$')
+
+    # individual evolution
+    eeLine, = ee.plot([], [], c=color[0], lw=0.5)
+    ee.yaxis.set_major_formatter(myFormatter())
+    ee_var = ee.twinx()
+    ee_varLine, = ee_var.plot([], [], c=color[1], lw=0.5)
+    ee_var.yaxis.set_major_formatter(myFormatter())
+    ee.axhline(y=0.0, c='black', ls='--', lw=1)  # xi_ref
+    ee.set_xlabel('Time (ps)')
+    ee.tick_params('y', colors=color[0])
+    ee.set_ylabel('$\\xi - \\xi_{\mathrm{ref}}$', color=color[0])
+    ee_var.tick_params('y', colors=color[1])
+    ee_var.set_ylabel('Variance', color=color[1])
+
+    # individual scatter
+    esLine, = es.plot([], [], c=color[0], marker='o', ls='', markersize=1)
+    es.xaxis.set_major_formatter(myFormatter())
+    es.yaxis.set_major_formatter(myFormatter())
+    es.axvline(x=0.0, c='black', ls='--', lw=1)  # xi_ref
+    es.set_ylabel('Variance')
+    es.set_xlabel('$\\xi - \\xi_{{\mathrm{{ref}}}}$')
+
+    suptitle = fig.suptitle('', x=0., y=0.95, horizontalalignment='left', verticalalignment='bottom')
+
+    if fmt == 'pdf':
+        from matplotlib.backends.backend_pdf import PdfPages  # imports fontTools, only needed here
+        pdf = PdfPages(outputPath(state, 'Variances.pdf'))
+    else:
+        clearFolder(state, 'Variances')
 
     for i in range(length):
-
-        fig = plt.figure()
-        gs = gridspec.GridSpec(2, 2)
-
-        me = fig.add_subplot(gs[0, 0])  # mean evolution
-        ms = fig.add_subplot(gs[0, 1])  # mean scatter
-        ee = fig.add_subplot(gs[1, 0])  # each evolution
-        es = fig.add_subplot(gs[1, 1])  # each scatter
-
-        xiMean = np.add(np.divide(umbInfo[0, :, i], umbInfo[2, :, i]), -xi_list[i])
-        varMean = umbInfo[4, :, i]
-
-        xiSum = umbInfo[0, :, i]
-        varSum = umbInfo[1, :, i]
-
-        stepCount = umbInfo[2, :, i]
-        timeCount = np.multiply(stepCount, delta)
-        timeCount_eff = 0
-        for k, kkk in enumerate(timeCount[1:]):
-            if timeCount[k + 1] > timeCount[k]:
-                timeCount_eff += 1
-            else:
-                break
-
-        xiSep = np.zeros(Ntraj)
-        varSep = np.zeros(Ntraj)
-
-        for j in range(Ntraj):
-            if j == 0:
-                xiSep[j] = umbInfo[3, 0, i]
-                varSep[j] = varMean[j]
-            elif j > 0:
-                stepsCurrent = stepCount[j] - stepCount[j - 1]
-                varSep[j] = (varSum[j] - varSum[j - 1]) / stepsCurrent - \
-                            ((xiSum[j] - xiSum[j - 1]) / stepsCurrent) ** 2
-                xiSep[j] = (xiSum[j] - xiSum[j - 1]) / stepsCurrent
-        # print(varSep)
-        # print(xiSep)
-        xiSep = np.add(xiSep, -xi_list[i])
-        xiSep_mean = np.mean(xiSep)
-        varSep_mean = np.mean(varSep)
+        xiMean = np.add(cumulativeMean[:, i], -state.xi_list[i])
+        varMean = cumulativeVariance[:, i]
+
+        stepCount = stepCounts[:, i]
+        timeCount = np.multiply(stepCount, state.delta)
+        # the number of steps while the time is increasing
+        increasing = np.diff(timeCount) > 0
+        timeCount_eff = len(increasing) if np.all(increasing) else np.argmin(increasing)
+
+        xiSep = blockMean[:, i].copy()
+        varSep = blockVariance[:, i].copy()
+        xiSep[0] = firstMean[i]
+        varSep[0] = varMean[0]
+        xiSep = np.add(xiSep, -state.xi_list[i])
         xiSep_max, xiSep_min = np.max(xiSep[:timeCount_eff]), np.min(xiSep[:timeCount_eff])
         varSep_max, varSep_min = np.max(varSep[:timeCount_eff]), np.min(varSep[:timeCount_eff])
         xiSep_range = xiSep_max - xiSep_min
         varSep_range = varSep_max - varSep_min
+        xiLim = (xiSep_min - xiSep_range * 0.1, xiSep_max + xiSep_range * 0.1)
+        varLim = (varSep_min - varSep_range * 0.1, varSep_max + varSep_range * 0.1)
 
-        # mean evolution
-        me.plot(timeCount, xiMean, c=color[0])
-        me.yaxis.set_major_formatter(myFormatter())
-        me_var = me.twinx()
-        me_var.plot(timeCount, varMean, c=color[1])
-        me_var.yaxis.set_major_formatter(formatter)
-        me.yaxis.set_major_formatter(myFormatter())
-        # me.axhline(y=xiSep_mean, c='blue', ls='--', zorder=10)
-        # me_var.axhline(y=varSep_mean, c='red', ls='--', zorder=10)
-        me.axhline(y=0.0, c='black', ls='--', lw=1)  # xi_ref
-        # axis label
-        me.set_xlabel('Time (ps)')
-        me.tick_params('y', colors=color[0])
-        # me.set_ylabel('$\\xi - \\xi_{{\mathrm{{ref}}}}, \\xi_{{\mathrm{{ref}}}} = {0:.3f}$'.format(xi_list[i]))
-        me.set_ylabel('$\\xi - \\xi_{{\mathrm{{ref}}}}$', color=color[0])
-        me_var.tick_params('y', colors=color[1])
-        me_var.set_ylabel('Variance', color=color[1])
-        # axis lim
-        me.set_ylim(xiSep_min - xiSep_range * 0.1, xiSep_max + xiSep_range * 0.1)
-        me_var.set_ylim(varSep_min - varSep_range * 0.1, varSep_max + varSep_range * 0.1)
-
-        # mean scatter
-        ms.plot(xiMean, varMean, c=color[0], marker='o', ls='', markersize=1)
-        ms.yaxis.set_major_formatter(myFormatter())
-        ms.xaxis.set_major_formatter(myFormatter())
-        ms.axvline(x=0.0, c='black', ls='--', lw=1)  # xi_ref
-        ms.set_ylabel('Variance')
-        ms.set_xlabel('$\\xi - \\xi_{{\mathrm{{ref}}}}$')
-        # axis lim
-        ms.set_ylim(varSep_min - varSep_range * 0.1, varSep_max + varSep_range * 0.1)
-        ms.set_xlim(xiSep_min - xiSep_range * 0.1, xiSep_max + xiSep_range * 0.1)
-
-        # individual evolution
-        ee.plot(timeCount, xiSep, c=color[0], lw=0.5)
-        ee.yaxis.set_major_formatter(myFormatter())
-        ee_var = ee.twinx()
-        ee_var.plot(timeCount, varSep, c=color[1], lw=0.5)
-        ee_var.yaxis.set_major_formatter(myFormatter())
-        # ee.axhline(y=xiSep_mean, c='blue', ls='--', zorder=10)
-        # ee_var.axhline(y=varSep_mean, c='red', ls='--', zorder=10)
-        ee.axhline(y=0.0, c='black', ls='--', lw=1)  # xi_ref
-        ee.set_xlabel('Time (ps)')
-        ee.tick_params('y', colors=color[0])
-        ee.set_ylabel('$\\xi - \\xi_{\mathrm{ref}}$', color=color[0])
-        ee_var.tick_params('y', colors=color[1])
-        ee_var.set_ylabel('Variance', color=color[1])
-        # axis lim
-        ee.set_ylim(xiSep_min - xiSep_range * 0.1, xiSep_max + xiSep_range * 0.1)
-        ee_var.set_ylim(varSep_min - varSep_range * 0.1, varSep_max + varSep_range * 0.1)
-
-        # individual scatter
-        es.plot(xiSep, varSep, c=color[0], marker='o', ls='', markersize=1)
-        es.xaxis.set_major_formatter(myFormatter())
-        es.yaxis.set_major_formatter(myFormatter())
-        # es.axhline(y=varSep_mean, c='red', ls='--', zorder=10)
-        # es.axvline(x=xiSep_mean, c='blue', ls='--', zorder=10)
-        es.axvline(x=0.0, c='black', ls='--', lw=1)  # xi_ref
-        es.set_ylabel('Variance')
-        es.set_xlabel('$\\xi - \\xi_{{\mathrm{{ref}}}}$')
-        # axis lim
-        es.set_ylim(varSep_min - varSep_range * 0.1, varSep_max + varSep_range * 0.1)
-        es.set_xlim(xiSep_min - xiSep_range * 0.1, xiSep_max + xiSep_range * 0.1)
+        meLine.set_data(timeCount, xiMean)
+        me_varLine.set_data(timeCount, varMean)
+        msLine.set_data(xiMean, varMean)
+        eeLine.set_data(timeCount, xiSep)
+        ee_varLine.set_data(timeCount, varSep)
+        esLine.set_data(xiSep, varSep)
 
-        # plt.show()
-        fig.suptitle(' Variance in window $\\xi_{{\mathrm{{ref}}}}={:.3f}$'.format(xi_list[i]),
-                     x=0., y=0.95, horizontalalignment='left', verticalalignment='bottom')
-        # fig.suptitle(mylabel,
-        #              x=1, y=0.95, horizontalalignment='right', verticalalignment='bottom')
-        plot_save('Variances\\{:0>3d}_{:.3f}'.format(i, xi_list[i]))
+        # axis lim
+        for ax in (me, ee):
+            ax.relim()
+            ax.autoscale_view(scaley=False)
+            ax.set_ylim(xiLim)
+        for ax in (me_var, ms, ee_var, es):
+            ax.set_ylim(varLim)
+        for ax in (ms, es):
+            ax.set_xlim(xiLim)
+
+        suptitle.set_text(' Variance in window $\\xi_{{\mathrm{{ref}}}}={:.3f}$'.format(state.xi_list[i]))
+        if i == 0:
+            fig.tight_layout()
+
+        with savefigTimer(state):
+            if fmt == 'pdf':
+                pdf.savefig(fig)
+            else:
+                name = os.path.join('Variances', '{:0>3d}_{:.3f}.png'.format(i, state.xi_list[i]))
+                fig.savefig(outputPath(state, name), format='png', dpi=600)
 
-    return
+    if fmt == 'pdf':
+        with savefigTimer(state):
+            pdf.close()
+    plt.close(fig)
 
 
-def plot_deviation():
+def plot_deviation(state):
     title = 'deviation'
     plot_parameters(title, width=9)
 
@@ -545,57 +660,70 @@ def plot_deviation():
     formatter2.set_powerlimits((-1, 1))
 
     # NtrajEff
-    xi_dev = np.zeros(len(xi_list))
-    var = np.zeros(len(xi_list))
-
-    for i in range(len(xi_list)):
-        xi_dev[i] = umbInfo[3, NtrajEff - 1, i] - xi_list[i]
-        tmp = umbInfo[1, NtrajEff - 1, i] / umbInfo[2, NtrajEff - 1, i] - \
-              (umbInfo[0, NtrajEff - 1, i] / umbInfo[2, NtrajEff - 1, i]) ** 2
-        var[i] = tmp * kforce_list[i] * 627.509474063056  # to kcal/mol
+    xi_dev = np.zeros(len(state.xi_list))
+    var = np.zeros(len(state.xi_list))
+
+    av, av2, count, mean = [umbColumn(state, column, state.NtrajEff - 1) for column in range(4)]
+    for i in range(len(state.xi_list)):
+        xi_dev[i] = mean[i] - state.xi_list[i]
+        tmp = av2[i] / count[i] - \
+              (av[i] / count[i]) ** 2
+        var[i] = tmp * state.kforce_list[i] * 627.509474063056  # to kcal/mol
         # * temp *, no temperature here.
 
-    plt.plot(xi_list, xi_dev * kforce_list, c=color[0])
+    plt.plot(state.xi_list, xi_dev * state.kforce_list, c=color[0])
     plt.gca().yaxis.set_major_formatter(formatter)
     plt.xlabel('$\\xi$')
     plt.ylabel('$(\\xi_i - \\xi^{\\mathrm{ref}}_i) k_i$')
 
     plot_var = plt.twinx()
-    plot_var.plot(xi_list[0], var[0], c=color[0], label='$(\\xi_i - \\xi^{\\mathrm{ref}}_i) k_i$') # for legend
-    plot_var.plot(xi_list, var, 'o-', c=color[1], markersize=2, lw=0.5, label='$\\sigma_i k_i$')
+    plot_var.plot(state.xi_list[0], var[0], c=color[0], label='$(\\xi_i - \\xi^{\\mathrm{ref}}_i) k_i$') # for legend
+    plot_var.plot(state.xi_list, var, 'o-', c=color[1], markersize=2, lw=0.5, label='$\\sigma_i k_i$')
     plot_var.yaxis.set_major_formatter(formatter2)
     plot_var.set_ylabel('$\\sigma_i k_i $ (kcal/mol)')
     # plot_var.set_minorticks_on()
 
     plot_var.legend(loc='best')
-    plot_save('xi_dev')
-
-def plot_pmf(path):
-    title = 'PMF'
-    plot_parameters(title)
+    plot_save(state, 'xi_dev')
 
+def readPMF(path):
+    """
+    The PMF computed by RPMDrate in `potential_of_mean_force.dat`, shifted to W(xi=0) = 0 and converted to kcal/mol.
+    Return the lists of xi and PMF, or None if there is no such file.
+    """
     try:
         f = open(path + '/potential_of_mean_force.dat', 'r')
     except FileNotFoundError:
-        print('[ERROR] {} file not found! '.format(title))
-    else:
-        fLines = f.readlines()
-        f.close()
+        return None
+    fLines = f.readlines()
+    f.close()
+
+    xi = []
+    pmf = []
+    for i in fLines[12:-1]:
+        xi.append(float(i.split()[0]))
+        pmf.append(float(i.split()[1]))
+
+    # Let W(xi=0) = 0!
+    xiAbs = np.abs(xi)
+    xiZeroIndex = list(xiAbs).index(min(np.abs(xi)))
+    pmf = [(x - pmf[xiZeroIndex]) / 27.211386245988 * 627.509474063056 for x in
+           pmf]  # shift and convert to kcal/mol
+    return xi, pmf
+
 
-        xi = []
-        pmf = []
-        for i in fLines[12:-1]:
-            xi.append(float(i.split()[0]))
-            pmf.append(float(i.split()[1]))
+def plot_pmf(state, path):
+    title = 'PMF'
+    plot_parameters(title)
 
-        # Let W(xi=0) = 0!
-        xiAbs = np.abs(xi)
-        xiZeroIndex = list(xiAbs).index(min(np.abs(xi)))
-        pmf = [(x - pmf[xiZeroIndex]) / 27.211386245988 * 627.509474063056 for x in
-               pmf]  # shift and convert to kcal/mol
+    data = readPMF(path)
+    if data is None:
+        print('[ERROR] {} file not found! '.format(title))
+    else:
+        xi, pmf = data
 
         # write PMF in kcal/mol
-        with open(os.path.join(figPath, 'PMF.txt'), 'w') as pmfFile:
+        with open(outputPath(state, 'PMF.txt'), 'w') as pmfFile:
             for i in range(len(xi)):
                 pmfFile.write('{:.6f}\t{:.10f}\n'.format(xi[i], pmf[i]))
 
@@ -608,7 +736,7 @@ def plot_pmf(path):
         plt.ylim(min(pmf) - yRange * 0.1,
                  max(pmf) + yRange * 0.1)  # adds 0.1*yRange to the top and bottom
 
-        plt.plot(xi, pmf, c=color[0], label=mylabel)
+        plt.plot(xi, pmf, c=color[0], label=state.mylabel)
 
         # # plot a zoomed subfigure
         # xiMaxIndex = pmf.index(max(pmf)) # the position of maximum
@@ -635,13 +763,14 @@ def plot_pmf(path):
 
         # plt.legend(loc='upper left')
         plt.legend(loc='best')
-        plot_save(title)
+        plot_save(state, title)
 
 
-def plot_rexFactor(path):
-    title = 'Transmission_Coefficient'
-    plot_parameters(title)
-
+def readRecrossing(path):
+    """
+    The transmission coefficient kappa(t) computed by RPMDrate in `recrossing_factor_*`.
+    Return the lists of time (fs) and kappa, or None if there is no such file.
+    """
     # Find the file first!
     fileList = os.listdir(path)
     rexFileName = ''
@@ -651,9 +780,6 @@ def plot_rexFactor(path):
 
     try:
         f = open(path + '/' + rexFileName, 'r')
-    except:
-        pass
-    try:
         fLines = f.readlines()
         f.close()
         time = []
@@ -662,6 +788,18 @@ def plot_rexFactor(path):
             ele = i.split()
             time.append(float(ele[0]))
             kappa.append(float(ele[-1]))
+    except:
+        return None
+    return time, kappa
+
+
+def plot_rexFactor(state, path):
+    title = 'Transmission_Coefficient'
+    plot_parameters(title)
+
+    data = readRecrossing(path)
+    try:
+        time, kappa = data
 
         plt.xlabel('$t$ (fs)')
         plt.ylabel('$\kappa(t)$')
@@ -672,19 +810,19 @@ def plot_rexFactor(path):
         # # endRF = np.mean(kappa[-5:])
         # plt.axhline(y=kappa[-1], c=color[0], lw=0.5, linestyle='--')
 
-        plt.plot(time, kappa, c=color[0], label=mylabel)
+        plt.plot(time, kappa, c=color[0], label=state.mylabel)
 
         plt.legend(loc="best")
-        plot_save(title)
+        plot_save(state, title)
 
-        with open(os.path.join(figPath, 'recrossing.txt'), 'w') as rexFile:
+        with open(outputPath(state, 'recrossing.txt'), 'w') as rexFile:
             for i in range(len(time)):
                 rexFile.write('{:.3f}\t{:.6f}\n'.format(time[i], kappa[i]))
     except:
         pass
 
-def plot_overlap_density(path):
-    if NtrajEff == 1:
+def plot_overlap_density(state, path):
+    if state.NtrajEff == 1:
         return
 
     title = 'Overlap_Density'
@@ -693,16 +831,18 @@ def plot_overlap_density(path):
     resolution = 2000
     extend = 0.03  # 3E-2
 
-    xiMin = np.min(xi_list)
-    xiMax = np.max(xi_list)
+    xiMin = np.min(state.xi_list)
+    xiMax = np.max(state.xi_list)
 
-    sizeV = NtrajEff  # np.shape(umbInfo)[1]
-    sizeH = np.shape(umbInfo)[2]
+    sizeV = state.NtrajEff  # np.shape(umbInfo)[1]
+    sizeH = len(state.xi_list)
+    xiMean = umbColumn(state, 3, dtype=np.float32)
+    xiVar = umbColumn(state, 4, dtype=np.float32)
 
     x_new = np.linspace(xiMin - extend, xiMax + extend, resolution)
 
     # Read time unit
-    tempFile = open(path + "\\mbrella_sampling_{0:.4f}.dat".format(xi_list[0]), 'r')
+    tempFile = open(path + "\\mbrella_sampling_{0:.4f}.dat".format(state.xi_list[0]), 'r')
     lines = tempFile.readlines()
     timeSep = float(lines[9].split()[4]) / 1000.0  # to ns
 
@@ -713,7 +853,7 @@ def plot_overlap_density(path):
     for j in range(sizeV):  # xi
         y_sum = np.zeros((resolution))
         for i in range(sizeH):  # var
-            y_new = my_gaussian(x_new, umbInfo[3, j, i], umbInfo[4, j, i])
+            y_new = my_gaussian(x_new, xiMean[j, i], xiVar[j, i])
             y_sum += y_new
             z[j * resolution:(j + 1) * (resolution)] = y_sum
 
@@ -729,13 +869,14 @@ def plot_overlap_density(path):
 
     plt.colorbar()
     # plt.title('The Evolution of Normalized Population')
-    plot_save(title)
+    plot_save(state, title)
 
     # 3D UI
     plot_parameters('UI (3D)')
     X, Y = np.meshgrid(x, y)
+    from mpl_toolkits.mplot3d import Axes3D  # registers the 3d projection
     fig = plt.figure(figsize=(5, 3.75))  # 1.25 * (4,3)
-    ax = fig.gca(projection='3d')
+    ax = fig.add_subplot(projection='3d')
     ax.plot_surface(X, Y, z, cmap='Greens', linewidth=0.2, edgecolors='black')
     ax.view_init(elev=20, azim=30)
 
@@ -744,30 +885,30 @@ def plot_overlap_density(path):
     ax.set_ylabel(r'Reaction Coordinate')
     ax.set_zlabel(r'Normalized Population')
 
-    plot_save('Overlap_Density_3D')
+    plot_save(state, 'Overlap_Density_3D')
 
-    clearFolder('UI')
-    for cycle in range(NtrajEff):
+    clearFolder(state, 'UI')
+    for cycle in range(state.NtrajEff):
         # if (cycle + 1) % np.ceil(NtrajEff / 10) == 0 or cycle == 0 or cycle == NtrajEff - 1:
         resolution = 2000
         extend = 0.03  # 3E-2
 
-        xiMin = np.min(xi_list)
-        xiMax = np.max(xi_list)
-        length = len(xi_list)
+        xiMin = np.min(state.xi_list)
+        xiMax = np.max(state.xi_list)
+        length = len(state.xi_list)
 
         x_new = np.linspace(xiMin - extend, xiMax + extend, resolution)
         y_sum = np.zeros((resolution))  # Total density line
 
         maxPop = 0  # maximum of the summation of all population
 
-        timeCurrent = umbInfo[2, cycle, 0] * delta  # * 1E-3 # to ps
+        timeCurrent = umbColumn(state, 2, cycle)[0] * state.delta  # * 1E-3 # to ps
         plot_parameters('UI at time {:.4f} ps'.format(timeCurrent))
         plt.figure(figsize=(9, 3))
 
         for i in range(length):
             # Gaussian smearing
-            xav, xav2 = umbInfo[3:, cycle, i]
+            xav, xav2 = xiMean[cycle, i], xiVar[cycle, i]
             y_new = my_gaussian(x_new, xav, xav2)
 
             if xav2 - 1E-8 < 0:
@@ -798,31 +939,31 @@ def plot_overlap_density(path):
         plt.yticks([])  # No ticks and labels in y axis
 
         plt.legend(loc='upper left')
-        plot_save('UI\\{:.0f}'.format(timeCurrent))
+        plot_save(state, 'UI\\{:.0f}'.format(timeCurrent))
 
 
 
-def plotKForce():
+def plotKForce(state):
     plot_parameters('force constant', width=9)
 
     markerline, stemlines, baseline = \
-        plt.stem(xi_list, kforce_list, use_line_collection=True,
+        plt.stem(state.xi_list, state.kforce_list, use_line_collection=True,
                  basefmt=' ', markerfmt=' ', linefmt=color[0])
     plt.setp(stemlines, 'linewidth', 0.5)
-    plt.scatter(xi_list, kforce_list, c=color[0], s=1, label=mylabel)
+    plt.scatter(state.xi_list, state.kforce_list, c=color[0], s=1, label=state.mylabel)
 
     # upper bound of force constants
-    kMax = np.zeros(len(xi_list))
-    for i in range(len(xi_list) - 1):
-        kMax[i] = 9 * 3.16681046247368 * 1E-6 / (xi_list[i + 1] - xi_list[i]) ** 2
+    kMax = np.zeros(len(state.xi_list))
+    for i in range(len(state.xi_list) - 1):
+        kMax[i] = 9 * 3.16681046247368 * 1E-6 / (state.xi_list[i + 1] - state.xi_list[i]) ** 2
         # print(kMax[i])
     kMax[-1] = kMax[-2]
-    plt.plot(xi_list, kMax, '--', lw=0.75, c=color[1], alpha=0.5)
+    plt.plot(state.xi_list, kMax, '--', lw=0.75, c=color[1], alpha=0.5)
     # emphasis the large force constants
     for i, kmax in enumerate(kMax):
-        if kforce_list[i] > kmax:
-            print('       Large kforce {:.3f} in xi={:.3f}'.format(kforce_list[i], xi_list[i]))
-            plt.scatter(xi_list[i], kforce_list[i], c='red', s=4, zorder=10)
+        if state.kforce_list[i] > kmax:
+            print('       Large kforce {:.3f} in xi={:.3f}'.format(state.kforce_list[i], state.xi_list[i]))
+            plt.scatter(state.xi_list[i], state.kforce_list[i], c='red', s=4, zorder=10)
             # markerline, stemlines, baseline = \
             #     plt.stem(xi_list[i], kforce_list[i], use_line_collection=True,
             #              basefmt=' ', markerfmt=' ', linefmt='red')
@@ -832,107 +973,297 @@ def plotKForce():
     plt.xlabel('Reaction Coordinate')
 
     # plt.xlim(min(xi_list), max(xi_list))
-    plt.ylim(0, max(kforce_list) * 1.1)
+    plt.ylim(0, max(state.kforce_list) * 1.1)
 
     # plt.legend(loc='lower right')
     plt.legend(loc='upper left')
-    plot_save('kforce')
-
-
-def plot_PMF_evolution(plot3D=False):
-    if NtrajEff == 1:
-        return
-
+    plot_save(state, 'kforce')
+
+
+def meanForce(state, binList, N, xi_mean, xi_var, beta, chunk=2000):
+    """
+    Umbrella integration: the mean force dA/dxi at each bin from the Gaussian approximation of all windows.
+    `N`, `xi_mean` and `xi_var` are the sample counts, means and variances of each window at one cycle.
+    The bins are processed `chunk` at a time to bound the memory of the (bins, windows) intermediates.
+    """
+    kforce = state.kforce_list * state.temp
+    dA = np.zeros(len(binList))
+    for start in range(0, len(binList), chunk):
+        xi = binList[start:start + chunk, np.newaxis]
+        p = 1.0 / np.sqrt(2 * np.pi * xi_var) * np.exp(-0.5 * (xi - xi_mean) ** 2 / xi_var)  # probability
+        dA0 = (1.0 / beta) * (xi - xi_mean) / xi_var - kforce * (xi - state.xi_list)
+        Np = N * p
+        dA[start:start + chunk] = np.sum(Np * dA0, axis=1) / np.sum(Np, axis=1)
+    return dA
+
+
+def integrateMeanForce(state, binList, N, xi_mean, xi_var, beta, order=4):
+    """
+    Cumulative integral of the mean force over the bins, i.e. the PMF (Hartree) at binList[1:], shifted to zero minimum.
+    Each bin is integrated by the Gauss-Legendre rule of `order` nodes, so that the PMF does not depend on the number
+    of bins. Also return the nodes, in increasing order, and the mean force at them.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    half = 0.5 * np.diff(binList)[:, np.newaxis]
+    xi = binList[:-1, np.newaxis] + half * (nodes + 1)
+    dA = meanForce(state, xi.ravel(), N, xi_mean, xi_var, beta).reshape(xi.shape)
+    A = np.cumsum(half[:, 0] * (dA @ weights))
+    return A - np.min(A), xi.ravel(), dA.ravel()
+
+
+def refineBarrier(state, binList, PMFcurrent, xiNodes, dA, xiZeroIndex, N, xi_mean, xi_var, beta):
+    """
+    Refine the maximum of the PMF `PMFcurrent` (kcal/mol) integrated by `integrateMeanForce` on `binList`, with the mean
+    force `dA` at its nodes `xiNodes`. The mean force is a smooth function of xi, so every maximum is located at a root
+    of it by Brent's method, between the nodes where it changes sign, and its height is the PMF at the end of its bin
+    plus the Gauss-Legendre integral of the mean force. The reference W(xi=0) = 0 is refined the same way.
+    Return (xi, PMF) of the highest maximum.
+    """
+    from scipy.optimize import brentq
+
+    nodes, weights = np.polynomial.legendre.leggauss(8)
+
+    def integral(start, end):  # of the mean force, in kcal/mol
+        half = 0.5 * (end - start)
+        xi = start + half * (nodes + 1)
+        return half * np.sum(weights * meanForce(state, xi, N, xi_mean, xi_var, beta)) * 627.503
+
+    # PMFcurrent[i] is the integral up to binList[i + 1]
+    index = np.argmax(PMFcurrent)
+    xiMax, pmfMax = binList[index + 1], PMFcurrent[index]
+    for i in np.flatnonzero((dA[:-1] > 0) & (dA[1:] <= 0)):
+        xi = brentq(lambda x: meanForce(state, np.array([x]), N, xi_mean, xi_var, beta)[0], xiNodes[i], xiNodes[i + 1],
+                    xtol=1e-12)
+        b = min(max(np.searchsorted(binList, xi) - 1, 0), len(PMFcurrent) - 1)  # the bin of xi
+        pmf = PMFcurrent[b] + integral(binList[b + 1], xi)
+        if pmf > pmfMax:
+            xiMax, pmfMax = xi, pmf
+
+    xiZero = np.clip(0., binList[0], binList[-1])
+    return xiMax, pmfMax - integral(binList[xiZeroIndex + 1], xiZero)
+
+
+def openPMFStore(state, mode='r', shape=None):
+    """
+    The PMF evolution store `PMF_evolution.npy` in the figure folder, a memory-mapped array of shape (cycles, bins - 1)
+    in kcal/mol, and its axes `PMF_evolution_axes.npz` with the `time` (ps) of each cycle, the `xi` of each bin and the
+    `free_energy` of `computePMFEvolution`.
+    With `mode='w+'` a new store of `shape` is created, otherwise the existing store is opened.
+    """
+    store = np.lib.format.open_memmap(os.path.join(state.figPath, 'PMF_evolution.npy'), mode=mode, dtype=np.float64,
+                                      shape=shape)
+    if mode == 'w+':
+        return store
+    with np.load(os.path.join(state.figPath, 'PMF_evolution_axes.npz')) as axes:
+        return store, axes['time'], axes['xi']
+
+
+def PMFBins(state):
+    """
+    The edges of the `--bins` bins of the PMF evolution, from the first to the last window.
+    """
+    if state.args.bins < 2:
+        raise ValueError('the PMF evolution needs at least 2 bins, got {}'.format(state.args.bins))
+    return np.linspace(min(state.xi_list), max(state.xi_list), state.args.bins, True)
+
+
+def computePMFEvolution(state):
+    """
+    Compute the PMF at every cycle and stream it into the store of `openPMFStore`, one cycle at a time.
+    Return the bins and the (time, xi, free energy) of the maximum at each cycle.
+    """
     print('[INFO] Computing PMF evolution...')
-    clearFolder('PMF')
 
-    # Constants
-    bins = 10000
-    beta = 4.35974417e-18 / (1.3806504e-23 * temp)
-    totalCycle = NtrajEff  #np.shape(umbInfo)[1]  # the number of trajectories
-    Nwindows = np.shape(umbInfo)[2]  # the number of windows
-
-    # middle variables for calculations
-    binList = np.linspace(min(xi_list), max(xi_list), bins, True)
-    dA = np.zeros(bins)
-    p = np.zeros(Nwindows)  # probability
-    dA0 = np.zeros(Nwindows)
+    totalCycle = state.NtrajEff  #np.shape(umbInfo)[1]  # the number of trajectories
+    binList = PMFBins(state)
 
     # PMF data storage
-    PMFdata = np.zeros((bins - 1, totalCycle))
+    PMFdata = openPMFStore(state, 'w+', (totalCycle, state.args.bins - 1))
     freeEnergy = np.zeros((3, totalCycle))  # time, xi, free energy
+    computePMFCycles(state, range(totalCycle), binList, PMFdata, freeEnergy)
 
-    for cycle in range(totalCycle):
-        # save 10 PMF figures
-        # if (cycle + 1) % np.ceil(totalCycle / 15) == 0 or cycle == 0 or cycle == totalCycle:
-            # for cycle in [-1]:
-        print('       Computing PMF evolution {} of {}'.format(cycle + 1, totalCycle))
-        N = umbInfo[2, cycle, :]
-        for n, xi in enumerate(binList):
-            for l in range(Nwindows):
-                # av = window.av / window.count
-                # av2 = window.av2 / window.count
-                xi_mean = umbInfo[3, cycle, l]  # computed
-                xi_var = umbInfo[4, cycle, l]  # computed
-                xi_window = xi_list[l]  # fixed
-                kforce = kforce_list[l] * temp  # fixed
-                p[l] = 1.0 / np.sqrt(2 * np.pi * xi_var) * np.exp(-0.5 * (xi - xi_mean) ** 2 / xi_var)
-                dA0[l] = (1.0 / beta) * (xi - xi_mean) / xi_var - kforce * (xi - xi_window)
-                # plt.plot(p, label=l)
-            dA[n] = np.sum(N * p * dA0) / np.sum(N * p)
-            # plt.legend()
-            # plt.show()
+    PMFdata.flush()
+    del PMFdata
+    np.savez(os.path.join(state.figPath, 'PMF_evolution_axes.npz'), time=freeEnergy[0], xi=binList[:-1],
+             free_energy=freeEnergy)
 
-        # Now integrate numerically to get the potential of mean force
-        potentialOfMeanForce = np.zeros((2, bins - 1))
-        A = 0.0
-        for n in range(bins - 1):
-            dx = binList[n + 1] - binList[n]
-            potentialOfMeanForce[0, n] = 0.5 * (binList[n] + binList[n + 1])
-            A += 0.5 * dx * (dA[n] + dA[n + 1])
-            potentialOfMeanForce[1, n] = A
-        potentialOfMeanForce[1, :] -= np.min(potentialOfMeanForce[1, :])
+    if state.args.pmfText:
+        writePMFText(state)
 
-        PMFcurrent = potentialOfMeanForce[1, :] * 627.503  # to kcal/mol
+    return binList, freeEnergy
 
-        # Let W(xi=0) = 0!
-        xiAbs = np.abs(binList)
-        xiZeroIndex = list(xiAbs).index(min(np.abs(binList)))
-        PMFcurrent = [x - PMFcurrent[xiZeroIndex] for x in PMFcurrent]
-        PMFdata[:, cycle] = PMFcurrent
 
-        timeCurrent = umbInfo[2, cycle, 0] * delta  # * 1E-3
+def computePMFCycles(state, cycles, binList, PMFdata, freeEnergy):
+    """
+    Compute the PMF of each of the `cycles` into the rows of `PMFdata`, and the (time, xi, free energy) of its
+    maximum into the columns of `freeEnergy`, in the same order.
+    """
+    # Constants
+    beta = 4.35974417e-18 / (1.3806504e-23 * state.temp)
+    xiZeroIndex = np.argmin(np.abs(binList))  # Let W(xi=0) = 0!
 
+    for row, cycle in enumerate(cycles):
+        print('       Computing PMF evolution {} of {}'.format(cycle + 1, state.NtrajEff))
+        N, xi_mean, xi_var = umbColumn(state, 2, cycle), umbColumn(state, 3, cycle), umbColumn(state, 4, cycle)
 
-        plot_parameters('PMF at time {:.0f} ps'.format(timeCurrent))
-        plt.plot(binList[:-1], PMFcurrent, c=color[0], label='{:.0f} ps'.format(timeCurrent))
-        plt.xlabel(r'Reaction Coordinate')
-        plt.ylabel(r'$W(\xi)$ (kcal/mol)')
-        plt.legend(loc='upper left')
-        plot_save('PMF\\{:.0f}'.format(timeCurrent))
+        # Now integrate numerically to get the potential of mean force
+        PMFcurrent, xiNodes, dA = integrateMeanForce(state, binList, N, xi_mean, xi_var, beta)
+        PMFcurrent *= 627.503  # to kcal/mol
+        PMFcurrent -= PMFcurrent[xiZeroIndex]
+        PMFdata[row] = PMFcurrent
+
+        timeCurrent = N[0] * state.delta  # * 1E-3
 
         # calculate free energy
-        pmfMaxValue = np.max(PMFcurrent)
-        pmfMaxIndex = PMFcurrent.index(pmfMaxValue)
-        freeEnergy[:, cycle] = timeCurrent, binList[pmfMaxIndex], pmfMaxValue
+        pmfMaxXi, pmfMaxValue = refineBarrier(state, binList, PMFcurrent, xiNodes, dA, xiZeroIndex, N, xi_mean, xi_var,
+                                              beta)
+        freeEnergy[:, row] = timeCurrent, pmfMaxXi, pmfMaxValue
         print(pmfMaxValue)
 
-    # # write PMF datas
-    # f = open('PMF_data.txt', 'w')
-    # f.write('\t'.join(map(str, list(umbInfo[2,:,0]))) + '\n') # map(str, value_list)
-    # for i in range(bins - 1):
-    #     f.write('\t'.join(map(str, PMFdata[i,:])) + '\n')
-
-    # write PMF datas
-    f = open(os.path.join(figPath, 'PMF_data.txt'), 'w')
-    for j in range(totalCycle):
-        for i in range(bins - 1):
-            f.write(
-                '{:.4f}\t{:.4f}\t{:.4f}\n'.format(umbInfo[2, j, 0] * delta, binList[i],  # * 1E-3
-                                                  PMFdata[
-                                                      i, j]))  # time to ns # ps # 2020-05-02 15:44:43 Wenbin, FAN @ SHU
-    f.close()
 
+def parseShard(shard):
+    """
+    The shard `k/N` as (k, N), with 1 <= k <= N.
+    """
+    try:
+        k, N = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise ValueError('shard {} is not of the form k/N'.format(shard))
+    if not 1 <= k <= N:
+        raise ValueError('shard {} is not between 1/{} and {}/{}'.format(shard, N, N, N))
+    return k, N
+
+
+def PMFShardSignature(state):
+    """
+    The signature of the data and parameters the shards of a PMF evolution must share.
+    """
+    return buildSignature(state, [PMFBins, computePMFCycles] + dataHelpers,
+                          umbrellaFiles(state), (state.args.bins,))
+
+
+def computePMFShard(state, shard):
+    """
+    Compute the PMF evolution of the k-th of N contiguous ranges of cycles into `PMF_shards/shard_k_of_N.npz`
+    in the figure folder, to be assembled by `mergePMFShards`.
+    """
+    k, N = parseShard(shard)
+    cycles = np.array_split(np.arange(state.NtrajEff), N)[k - 1]
+    print('[INFO] Computing PMF evolution of shard {}/{}: cycles {} to {} of {}...'.format(
+        k, N, cycles[0] + 1 if len(cycles) else 0, cycles[-1] + 1 if len(cycles) else 0, state.NtrajEff))
+
+    binList = PMFBins(state)
+    PMFdata = np.zeros((len(cycles), state.args.bins - 1))
+    freeEnergy = np.zeros((3, len(cycles)))
+    computePMFCycles(state, cycles, binList, PMFdata, freeEnergy)
+
+    folder = os.path.join(state.figPath, 'PMF_shards')
+    os.makedirs(folder, exist_ok=True)
+    fname = os.path.join(folder, 'shard_{}_of_{}.npz'.format(k, N))
+    with open(fname + '.tmp', 'wb') as f:
+        np.savez(f, cycles=cycles, total=state.NtrajEff, signature=PMFShardSignature(state), xi=binList[:-1],
+                 pmf=PMFdata, free_energy=freeEnergy)
+    os.replace(fname + '.tmp', fname)
+    print('[INFO] Shard saved into {}'.format(fname))
+
+
+def mergePMFShards(state):
+    """
+    Assemble the PMF evolution store of `openPMFStore` from the shards of `computePMFShard`, as `computePMFEvolution`.
+    All the N shards of one run must be there and have been computed from the same data and parameters.
+    """
+    print('[INFO] Merging PMF evolution shards...')
+    folder = os.path.join(state.figPath, 'PMF_shards')
+    shards = {}
+    for file in os.listdir(folder) if os.path.isdir(folder) else []:
+        if file.startswith('shard_') and file.endswith('.npz'):
+            k, _, N = file[6:-4].partition('_of_')
+            shards.setdefault(int(N), {})[int(k)] = os.path.join(folder, file)
+    complete = [N for N in shards if len(shards[N]) == N]
+    if len(complete) != 1:
+        raise RuntimeError('expected the shards 1/N to N/N of one run in {}, found {}'.format(
+            folder, ', '.join('{}/{}'.format(k, N) for N in sorted(shards) for k in sorted(shards[N])) or 'none'))
+    N = complete[0]
+
+    binList = PMFBins(state)
+    signature = PMFShardSignature(state)
+    PMFdata = openPMFStore(state, 'w+', (state.NtrajEff, state.args.bins - 1))
+    freeEnergy = np.zeros((3, state.NtrajEff))
+    done = np.zeros(state.NtrajEff, dtype=bool)
+    for k in range(1, N + 1):
+        with np.load(shards[N][k]) as shard:
+            if shard['signature'] != signature or shard['total'] != state.NtrajEff:
+                raise RuntimeError('shard {}/{} was computed from other data, bins or code, compute it again'.format(
+                    k, N))
+            cycles = shard['cycles']
+            PMFdata[cycles] = shard['pmf']
+            freeEnergy[:, cycles] = shard['free_energy']
+            done[cycles] = True
+    if not done.all():
+        raise RuntimeError('the shards miss the cycles {}'.format(np.flatnonzero(~done) + 1))
+    print('       {} cycles from {} shards'.format(state.NtrajEff, N))
+
+    PMFdata.flush()
+    del PMFdata
+    np.savez(os.path.join(state.figPath, 'PMF_evolution_axes.npz'), time=freeEnergy[0], xi=binList[:-1],
+             free_energy=freeEnergy)
+
+    if state.args.pmfText:
+        writePMFText(state)
+
+    return binList, freeEnergy
+
+
+def writePMFText(state):
+    """
+    Export the PMF evolution store into `PMF_data.txt`, one `time xi PMF` line per cycle and bin.
+    """
+    PMFdata, times, xi = openPMFStore(state)
+    with open(os.path.join(state.figPath, 'PMF_data.txt'), 'w') as f:
+        for j, timeCurrent in enumerate(times):
+            # time to ns # ps # 2020-05-02 15:44:43 Wenbin, FAN @ SHU
+            block = np.column_stack((np.full(len(xi), timeCurrent), xi, PMFdata[j]))
+            np.savetxt(f, block, fmt='%.4f', delimiter='\t')
+
+
+def selectFrames(policy, totalCycle):
+    """
+    The cycles to render a PMF figure for, according to `policy`:
+    `all`, `none`, `every:k` (every k-th cycle), `log:n` (n log-spaced cycles) or `last:n` (the last n cycles).
+    `every` and `log` always keep the first and the last cycle.
+    """
+    kind, _, number = policy.partition(':')
+    try:
+        if kind == 'all':
+            return list(range(totalCycle))
+        elif kind == 'none':
+            return []
+        elif kind == 'every':
+            frames = list(range(0, totalCycle, int(number)))
+        elif kind == 'log':
+            frames = list(np.geomspace(1, totalCycle, int(number)).astype(int) - 1)
+        elif kind == 'last':
+            return list(range(max(totalCycle - int(number), 0), totalCycle))
+        else:
+            raise ValueError
+    except ValueError:
+        print('[ERROR] Frame policy {} not support and will be regarded as `all`. '.format(policy))
+        return list(range(totalCycle))
+    return sorted(set(frames) | {0, totalCycle - 1})
+
+
+def plot_PMF_frame(state, cycle):
+    PMFdata, times, xi = openPMFStore(state)
+    PMFcurrent, timeCurrent = PMFdata[cycle], times[cycle]
+    plot_parameters('PMF at time {:.0f} ps'.format(timeCurrent))
+    plt.plot(xi, PMFcurrent, c=color[0], label='{:.0f} ps'.format(timeCurrent))
+    plt.xlabel(r'Reaction Coordinate')
+    plt.ylabel(r'$W(\xi)$ (kcal/mol)')
+    plt.legend(loc='upper left')
+    plot_save(state, os.path.join('PMF', '{:.0f}'.format(timeCurrent)))
+
+
+def plot_free_energy(state, freeEnergy):
     # Plot free energy
     plot_parameters('free energy')
 
@@ -952,40 +1283,34 @@ def plot_PMF_evolution(plot3D=False):
 
     ax2.legend(loc='best')
 
-    plot_save('PMF_free_energy')
+    plot_save(state, 'PMF_free_energy')
 
-    if not plot3D:
-        return
 
+def plot_PMF_3D(state):
     # Plot PMF evolution
     plot_parameters('PMF evolution')
 
-    a = pd.read_csv(os.path.join(figPath, 'PMF_data.txt'), sep='\t', header=None)
-
-    traj = list(a.iloc[:, 0])
-    xibins = list(a.iloc[:, 1])
-    pmfvalue = list(a.iloc[:, 2])
+    PMFdata, times, xi = openPMFStore(state)
+    Y, X = np.meshgrid(xi, times)
 
-    pmfMin = np.min(pmfvalue)
-    pmfMax = np.max(pmfvalue)
+    pmfMin = np.min(PMFdata)
+    pmfMax = np.max(PMFdata)
     level = np.arange(int(pmfMin) - 2, int(pmfMax) + 2, 1)
 
-    plt.tricontourf(traj, xibins, pmfvalue, levels=level, cmap='Blues')
+    plt.contourf(X, Y, PMFdata, levels=level, cmap='Blues')
     plt.colorbar()
-    plt.tricontour(traj, xibins, pmfvalue, linestyles='-', levels=level, colors='Black', linewidths=0.2)
+    plt.contour(X, Y, PMFdata, linestyles='-', levels=level, colors='Black', linewidths=0.2)
 
     plt.xlabel(r'Time (ps)')
     plt.ylabel(r'Reaction Coordinate')
-    plot_save('PMF_evolution')
+    plot_save(state, 'PMF_evolution')
 
     # 3D plot
-    # print(len(traj), (totalCycle, bins - 1))
-    X = np.reshape(traj, (totalCycle, bins - 1))
-    Y = np.reshape(xibins, (totalCycle, bins - 1))
-    Z = np.reshape(pmfvalue, (totalCycle, bins - 1))
+    Z = PMFdata
 
+    from mpl_toolkits.mplot3d import Axes3D  # registers the 3d projection
     fig = plt.figure(figsize=(5, 3.75))  # 1.25 * (4,3)
-    ax = fig.gca(projection='3d')
+    ax = fig.add_subplot(projection='3d')
     ax.plot_surface(X, Y, Z, cmap='Blues', linewidth=0.2, edgecolors='black')
     ax.view_init(elev=20, azim=30)
 
@@ -993,48 +1318,73 @@ def plot_PMF_evolution(plot3D=False):
     ax.set_ylabel(r'Reaction Coordinate')
     ax.set_zlabel(r'Free Energy (kcal/mol)')
 
-    plot_save('PMF_evolution_3D')
+    plot_save(state, 'PMF_evolution_3D')
 
 
+def PMFEvolutionJobs(state, plot3D=False):
+    """
+    Compute the PMF evolution and return the plotting jobs of its figures:
+    the free energy, the 3D evolution if `plot3D`, and the PMF of the cycles selected by `--frames`.
+    """
+    if state.NtrajEff == 1:
+        return []
 
-def plot_xi():
+    outputs = ['PMF_evolution.npy', 'PMF_evolution_axes.npz'] + (['PMF_data.txt'] if state.args.pmfText else [])
+    signature = buildSignature(state, [computePMFEvolution] + dataHelpers,
+                               umbrellaFiles(state), (state.args.bins, state.args.pmfText))
+    if state.args.incremental and upToDate(state, 'computePMFEvolution', signature):
+        print('[INFO] PMF evolution is up to date. ')
+        with np.load(os.path.join(state.figPath, 'PMF_evolution_axes.npz')) as axes:
+            freeEnergy = axes['free_energy']
+    else:
+        clearFolder(state, 'PMF')
+        if state.args.merge:
+            with profileStage(state, 'mergePMFShards'):
+                binList, freeEnergy = mergePMFShards(state)
+        else:
+            with profileStage(state, 'computePMFEvolution'):
+                binList, freeEnergy = computePMFEvolution(state)
+        recordBuild(state, 'computePMFEvolution', signature, outputs)
+        uploadFiles(state, outputs)
+
+    jobs = [(plot_free_energy, (freeEnergy,))]
+    if plot3D:
+        jobs.append((plot_PMF_3D, ()))
+    for cycle in selectFrames(state.args.frames, state.NtrajEff):
+        jobs.append((plot_PMF_frame, (cycle,)))
+    return jobs
+
+
+def plot_PMF_evolution(state, plot3D=False):
+    renderFigures(state, PMFEvolutionJobs(state, plot3D))
+
+
+def plot_xi(state):
     plot_parameters('xi evolution')
 
-    length = len(xi_list)
-    xiref_evolution = np.zeros((Ntraj, length))
+    length = len(state.xi_list)
+    xiref_evolution = umbColumn(state, 0, dtype=np.float32) / umbColumn(state, 2, dtype=np.float32) - state.xi_list
 
-    timeMax = 0.0
-    timeMin = 1E5
-    for i in range(length):
-        tscolor = (((Tcolor2[0] - Tcolor1[0]) * i / length + 0) / 255.0,
-                   ((Tcolor2[1] - Tcolor1[1]) * i / length + 68) / 255.0,
-                   ((Tcolor2[2] - Tcolor1[2]) * i / length + 124) / 255.0)
-
-        timeEvolution = umbInfo[2, :, i]
-        timeEvolution = [x * delta for x in
-                         timeEvolution]  # 0.1 fs to 1 ns #  * 1E-3 # ps # 2020-05-02 15:46:21 Wenbin, FAN @ SHU
-        xiEvolution = umbInfo[3, :, i]
-        xiref_evolution[:, i] = np.add(np.divide(umbInfo[0, :, i], umbInfo[2, :, i]), -xi_list[i])
-
-        # light color for normal xi
-        alpha = 0.0
-        if max(xiEvolution) - min(xiEvolution) > (xi_list[1] - xi_list[0]) / 5.0:
-            alpha = 1.0
-        else:
-            alpha = 0.3
+    # from SHU blue to Weichang red
+    tscolor = (np.outer(np.arange(length) / length, np.subtract(Tcolor2, Tcolor1)) + Tcolor1) / 255.0
+
+    timeEvolution = umbColumn(state, 2, dtype=np.float32) * state.delta  # 0.1 fs to 1 ns #  * 1E-3 # ps # 2020-05-02 15:46:21 Wenbin, FAN @ SHU
+    xiEvolution = umbColumn(state, 3, dtype=np.float32)
 
-        plt.plot(timeEvolution, umbInfo[3, :, i], c=tscolor, lw=0.5, alpha=alpha)
+    # light color for normal xi
+    alpha = np.where(np.nanmax(xiEvolution, axis=0) - np.nanmin(xiEvolution, axis=0) >
+                     (state.xi_list[1] - state.xi_list[0]) / 5.0,
+                     1.0, 0.3)
 
-        if max(timeEvolution) > timeMax:
-            timeMax = max(timeEvolution)
-        if min(timeEvolution) < timeMin:
-            timeMin = min(timeEvolution)
+    plot_lines(timeEvolution, xiEvolution, tscolor, lw=0.5, alpha=alpha)
+
+    timeMax = np.nanmax(timeEvolution)
 
     plt.xlim(0, timeMax)  # timeMin, timeMax
     plt.xlabel('Time (ps)')
     plt.ylabel('Reaction Coordinates')
 
-    plot_save('xi_evolution')
+    plot_save(state, 'xi_evolution')
 
     plot_parameters('xi-ref_evolution')
     formatter = ticker.ScalarFormatter(useMathText=True)
@@ -1054,58 +1404,26 @@ def plot_xi():
 
     return
 
-def plot_xi_diff():
-    if NtrajEff == 1:
+def plot_xi_diff(state):
+    if state.NtrajEff == 1:
         return
 
     title = 'xi_diff'
     plot_parameters(title)
 
-    xiMin = np.min(xi_list)
-    xiMax = np.max(xi_list)
-    length = len(xi_list)
-
-    timeMax = 0.0
-    timeMin = 1E5
-
-    v = []
-
-    for i in range(length):
-        av = umbInfo[0, :, i]
-        #av2 = umbInfo[1, :, i]
-        timeEvolution = umbInfo[2, :, i]
-
-        Nsample = len(av)
-        mean = np.zeros(Nsample)
-        #variance = np.zeros(Nsample)
-        for j in range(Nsample):
-            if j == 0:
-                dmean = av[0] / timeEvolution[0]
-                mean[j] = dmean
-                ##variance[0] = av2[0] / timeEvolution[0] - dmean * dmean
-            else:
-                dt = timeEvolution[j] - timeEvolution[j-1]
-                dmean = (av[j] - av[j-1])  / dt
-                mean[j] = dmean
-                ##variance[j] = (av2[j] - av2[j-1]) / dt - dmean * dmean
-                # print(i, xi_list[i], variance[j], dt, dmean, av[j], av2[j])
-        mean -= xi_list[i]
-
-        v.append(mean)
+    xiMin = np.min(state.xi_list)
+    xiMax = np.max(state.xi_list)
+    length = len(state.xi_list)
 
-        tscolor = (int((255. * i / length)) / 255.0,
-                   0.,
-                   (int(-255. * i / length + 255)) / 255.0)
+    blockMean, blockVariance, jumpRatio = blockStatistics(state)
+    mean = blockMean - state.xi_list
+    v = [mean[:, i] for i in range(length)]
 
-        timeStep = delta
-        timeEvolution = [x * timeStep for x in timeEvolution]  # 0.1 fs to 1 ns
+    timeEvolution = umbColumn(state, 2, dtype=np.float32) * state.delta  # 0.1 fs to 1 ns
+    plot_lines(timeEvolution, mean, gradientColor(length), lw=0.2, alpha=0.4)
 
-        plt.plot(timeEvolution, mean, lw=0.2, c=tscolor, alpha=0.4)
-
-        if max(timeEvolution) > timeMax:
-            timeMax = max(timeEvolution)
-        if min(timeEvolution) < timeMin:
-            timeMin = min(timeEvolution)
+    timeMax = np.nanmax(timeEvolution)
+    timeMin = np.nanmin(timeEvolution)
 
     plt.xlabel('Time (ps)')
     plt.ylabel('$\\xi - \\xi ^ {\\mathrm{ref}}$')
@@ -1121,13 +1439,13 @@ def plot_xi_diff():
     formatter.set_powerlimits((-1, 1))
     plt.gca().yaxis.set_major_formatter(formatter)
 
-    plot_save(title)
+    plot_save(state, title)
 
     title = 'xi_diff_box'
     plot_parameters(title, width=8)
     for i in range(len(v)):
-        v[i] = np.multiply(v[i], kforce_list[i])
-    plt.boxplot(v, positions=xi_list, widths=0.003, labels=None,
+        v[i] = np.multiply(v[i], state.kforce_list[i])
+    plt.boxplot(v, positions=state.xi_list, widths=0.003, labels=None,
                 whiskerprops={'lw': 0.5},
                 capprops={'lw':0.5},
                 medianprops={'lw':1, 'color': color[1]}, # mean line
@@ -1138,22 +1456,21 @@ def plot_xi_diff():
     data_delta = data_range * 0.03
     plt.xlim(xiMin - data_delta, xiMax + data_delta)
     plt.ylabel('$k (\\xi - \\xi ^ {\\mathrm{ref}})$')
-    plt.xticks(myticks)
+    plt.xticks(state.myticks)
 
     formatter = ticker.ScalarFormatter(useMathText=True)
     formatter.set_scientific(True)
     formatter.set_powerlimits((-1, 1))
     plt.gca().yaxis.set_major_formatter(formatter)
 
-    plot_save(title)
+    plot_save(state, title)
 
     return
 
 
-def getBasicInfo(path):
-    global args
-    T=args.T
-    N=args.N
+def getBasicInfo(state, path):
+    T=state.args.T
+    N=state.args.N
     
     """# get the name of submitting script
     subList = ['run.sh', 'highcpu', 'fat', 'gpu', 'pbs', 'run.txt', 'sub.lsf', 'sub.pbs', 'fat.yy']  # submitting script
@@ -1196,119 +1513,673 @@ def getBasicInfo(path):
 
     # get input file, temperature and the number of bsubmitting scripteads
     assert len(cmdLine) == 3, 'Your submitting script may be wrong! '"""
-    global inputFile, temp, Nbeads  # There will be probably more pythonic way. Tell me plz if you know!
-    inputFile = args.I
-    temp = float(T)
-    Nbeads = N
+    state.inputFile = state.args.I
+    state.temp = float(T)
+    state.Nbeads = N
 
     print('       Temperature:      {} K'.format(T))
-    print('       Number of beads:  {}'.format(Nbeads))
-    print('       Input file:       {}\n'.format(inputFile))
+    print('       Number of beads:  {}'.format(state.Nbeads))
+    print('       Input file:       {}\n'.format(state.inputFile))
+
+    return state.inputFile
+
+
+def readUmbrellaFile(fname, offset=0, lastLine=True):
+    """
+    Read one umbrella sampling file in a single pass, or only the lines appended after byte `offset`.
+    Return the (Nlines, 5) data below the 15 info lines, the time separation on line 10 (None if `offset` > 0)
+    and the offset after the lines read.
+    A last line without line break is skipped unless `lastLine`, since it may be still being written.
+    The file stops at its first malformed line, so that the lines of all windows stay aligned by cycle;
+    the returned offset is then the start of that line.
+    """
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        content = f.read()
+    if not lastLine:
+        content = content[:content.rfind(b'\n') + 1]
+    lines = content.splitlines()
+    start = offset
+    sep = None
+    if offset == 0:
+        if len(lines) < 15 and not lastLine:  # the info lines are not complete yet
+            return np.zeros((0, 5)), None, 0
+        sep = float(lines[9].split()[4])
+        lines = lines[15:]  # 15 info lines
+    offset += len(content)
+
+    # Fast path: every non-empty line has exactly five columns
+    rows = [row for row in map(bytes.split, lines) if row]
+    Nlines = len(rows)
+    if all(len(row) == 5 for row in rows):
+        try:
+            return np.array(rows, dtype=float).reshape(Nlines, 5), sep, offset
+        except ValueError:
+            pass
+
+    rawLines = content.splitlines(True)
+    skipped = len(rawLines) - len(lines)  # the info lines
+    offset = start + sum(len(line) for line in rawLines[:skipped])
+    data = []
+    for line in rawLines[skipped:]:
+        values = line.split()
+        if len(values) > 0:
+            try:
+                values = np.array(values, dtype=float)
+            except ValueError:
+                values = []
+            if len(values) != 5:
+                break
+            data.append(values)
+        offset += len(line)
+    else:
+        return np.reshape(data, (len(data), 5)), sep, offset
+    Nwrong = Nlines - len(data)
+    print('[WARNING] {} has a wrong line after {} cycles, it and the {} line(s) after it are ignored! '.format(
+        fname, len(data), Nwrong - 1))
+    return np.reshape(data, (len(data), 5)), sep, offset
+
+
+def fileFingerprint(fname):
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def umbrellaParserVersion():
+    """
+    The hash of the code of `readUmbrellaFile`, so that a cache is not used by another version of the parser.
+    """
+    return hashlib.sha1(inspect.getsource(readUmbrellaFile).encode()).hexdigest()
+
+
+def loadUmbrellaCache(state):
+    """
+    Return {file name: (fingerprint, data, time separation)} from the cache in the figure folder,
+    or nothing if the cache was written by another version of `readUmbrellaFile`.
+    """
+    cache = {}
+    cacheFile = os.path.join(state.figPath, 'umbrella_cache.npz')
+    if state.args.noCache or not os.path.exists(cacheFile):
+        return cache
+    try:
+        with np.load(cacheFile) as npz:  # each access of a member reads it again from the archive
+            if 'parser' not in npz.files or str(npz['parser']) != umbrellaParserVersion():
+                print('[INFO] Cache file {} was written by another version of the parser and will be rebuilt. '
+                      .format(cacheFile))
+                return cache
+            files, fingerprints, lengths = npz['files'], npz['fingerprints'], npz['lengths']
+            data, timeSep = npz['data'], npz['timeSep']
+        offsets = np.append(0, np.cumsum(lengths))
+        for i, fname in enumerate(files):
+            cache[str(fname)] = (tuple(fingerprints[i]), data[offsets[i]:offsets[i + 1]], timeSep[i])
+    except (OSError, KeyError, ValueError):
+        print('[WARNING] Cache file {} is broken and will be rebuilt. '.format(cacheFile))
+        return {}
+    return cache
+
+
+def saveUmbrellaCache(state, fileList, fingerprints, fileData):
+    if state.args.noCache:
+        return
+    cacheFile = os.path.join(state.figPath, 'umbrella_cache.npz')
+    tmpFile = '{}.{}.tmp'.format(cacheFile, os.getpid())  # the shards of a task may run at the same time
+    with open(tmpFile, 'wb') as f:
+        np.savez(f, parser=umbrellaParserVersion(), files=[os.path.basename(fname) for fname in fileList],
+                 fingerprints=np.array(fingerprints, dtype=np.int64).reshape(len(fileList), 2),
+                 lengths=[len(data) for data, sep in fileData],
+                 data=np.concatenate([data for data, sep in fileData]),
+                 timeSep=[sep for data, sep in fileData])
+    os.replace(tmpFile, cacheFile)
 
-    return inputFile
 
+def umbrellaFiles(state):
+    return [state.path + "/umbrella_sampling_{0:.8f}.dat".format(xi) for xi in state.xi_list]
 
-def getUmbrellaInfo(path):
+
+def getUmbrellaInfo(state):
     print('[INFO] Getting umbrella data...')
-    Nwindows = len(xi_list)
+    Nwindows = len(state.xi_list)
     print('       number of windows: {}'.format(Nwindows))
 
+    # Only parse the files changed since the last run
+    fileList = umbrellaFiles(state)
+    fingerprints = [fileFingerprint(fname) for fname in fileList]
+    cache = loadUmbrellaCache(state)
+    fileData = [None] * Nwindows
+    for i, fname in enumerate(fileList):
+        cached = cache.get(os.path.basename(fname))
+        if cached is not None and cached[0] == fingerprints[i]:
+            fileData[i] = cached[1:]
+    readList = [i for i in range(Nwindows) if fileData[i] is None]
+    print('       windows from cache: {}'.format(Nwindows - len(readList)))
+
+    if state.args.ioThreads > 1:
+        with ThreadPoolExecutor(max_workers=state.args.ioThreads) as pool:
+            for i, data in zip(readList, pool.map(readUmbrellaFile, [fileList[i] for i in readList])):
+                fileData[i] = data[:2]
+    else:
+        for i in readList:
+            fileData[i] = readUmbrellaFile(fileList[i])[:2]
+    if len(readList) > 0:
+        saveUmbrellaCache(state, fileList, fingerprints, fileData)
+
     # Count the total lines of xi and xvar
-    NtrajList = np.zeros(Nwindows)
-    for i in range(Nwindows):
-        with open(path + "/umbrella_sampling_{0:.8f}.dat".format(xi_list[i]), 'r') as tempFile:
-            for j, l in enumerate(tempFile):
-                pass
-        NtrajList[i] = j + 1 - 15  # 15 info lines # +1 means the number of lines
-
-    global Ntraj, NtrajEff
-    
-    Ntraj = int(np.max(NtrajList))
-    NtrajEff = int(np.min(NtrajList))  # Effective lines
-    print('       Maximum of trajectories: {}'.format(Ntraj))
-    print('       Minimum of trajectories: {}\n'.format(NtrajEff))
+    NtrajList = [len(data) for data, sep in fileData]
 
-    global umbInfo
-    umbInfo = np.zeros((5, Ntraj, Nwindows))  # `5` means five columns in the umbrella info files.
+    state.Ntraj = int(np.max(NtrajList))
+    state.NtrajEff = int(np.min(NtrajList))  # Effective lines
+    print('       Maximum of trajectories: {}'.format(state.Ntraj))
+    print('       Minimum of trajectories: {}\n'.format(state.NtrajEff))
 
     # Read time unit
-    tempFile = open(path + "/umbrella_sampling_{0:.8f}.dat".format(xi_list[0]), 'r')
-    lines = tempFile.readlines()
-    timeSep = float(lines[9].split()[4])  # / 1000.0  # to ns # ps # 2020-05-02 15:46:42 Wenbin, FAN @ SHU
-    tempFile.close()
+    state.timeSep = fileData[0][1]  # / 1000.0  # to ns # ps # 2020-05-02 15:46:42 Wenbin, FAN @ SHU
+
+    if state.args.compact:
+        # ragged: the lines of all windows one after another, see `umbColumn`
+        state.umbLengths = np.array(NtrajList)
+        state.umbOffsets = np.append(0, np.cumsum(NtrajList))
+        state.umbInfo = np.concatenate([data for data, sep in fileData])
+        return state.umbInfo
+
+    state.umbLengths = state.umbOffsets = None
+    state.umbInfo = np.full((5, state.Ntraj, Nwindows), np.nan)  # `5` means five columns in the umbrella info files.
+    for i, (data, sep) in enumerate(fileData):
+        state.umbInfo[:, :len(data), i] = data.T
+
+    return state.umbInfo
+
+
+def umbColumn(state, column, rows=slice(None), dtype=np.float64):
+    """
+    The `column` of the umbrella data at the cycles `rows` (an index or a slice) of all windows,
+    NaN beyond the end of the shorter windows. This is a view of `umbInfo`, or with `--compact` a copy in `dtype`
+    built from the ragged data; plotting-only paths ask for float32.
+    """
+    if state.umbLengths is None:
+        return state.umbInfo[column, rows]
+    return raggedToDense(state, state.umbInfo[:, column], rows, dtype)
+
+
+def raggedToDense(state, values, rows=slice(None), dtype=np.float64):
+    """
+    Spread `values` given for each line of the ragged umbrella data into the (cycles, windows) layout.
+    """
+    cycles = np.arange(state.Ntraj)[rows]
+    valid = np.less.outer(cycles, state.umbLengths)
+    dense = np.full(valid.shape, np.nan, dtype=dtype)
+    dense[valid] = values[(state.umbOffsets[:-1] + np.asarray(cycles)[..., np.newaxis])[valid]]
+    return dense
+
+
+def watchUmbrellaInfo(state):
+    """
+    Keep refreshing the overlap, variance and PMF figures every `--interval` seconds while the umbrella sampling
+    is running, until interrupted. Only the lines appended to each file since the last refresh are parsed.
+    """
+    print('[INFO] Watching umbrella data, press Ctrl+C to stop...')
+    Nwindows = len(state.xi_list)
+    fileList = umbrellaFiles(state)
+    offsets = [0] * Nwindows
+    NtrajList = np.zeros(Nwindows, dtype=int)
+    umbBuffer = np.full((5, 0, Nwindows), np.nan)  # grows by doubling, `umbInfo` is a view of its first Ntraj lines
 
-    # Read in all data
-    for i in range(Nwindows):
-        fname = path + "/umbrella_sampling_{0:.8f}.dat".format(xi_list[i])
-        f = open(fname, 'r').readlines()
+    try:
+        while True:
+            changed = False
+            for i, fname in enumerate(fileList):
+                if not os.path.exists(fname) or os.path.getsize(fname) == offsets[i]:
+                    continue
+                if os.path.getsize(fname) < offsets[i]:  # truncated or rewritten, read it again
+                    print('[WARNING] {} was rewritten and will be read again. '.format(fname))
+                    offsets[i] = 0
+                    NtrajList[i] = 0
+                    umbBuffer[:, :, i] = np.nan
+                    changed = True
+                data, sep, offsets[i] = readUmbrellaFile(fname, offsets[i], lastLine=False)
+                if sep is not None and i == 0:
+                    state.timeSep = sep
+                if len(data) == 0:
+                    continue
+
+                if NtrajList[i] + len(data) > umbBuffer.shape[1]:
+                    size = max(2 * umbBuffer.shape[1], NtrajList[i] + len(data))
+                    umbBuffer = np.concatenate(
+                        (umbBuffer, np.full((5, size - umbBuffer.shape[1], Nwindows), np.nan)), axis=1)
+                umbBuffer[:, NtrajList[i]:NtrajList[i] + len(data), i] = data.T
+                NtrajList[i] += len(data)
+                changed = True
+
+            state.Ntraj = int(np.max(NtrajList))
+            state.NtrajEff = int(np.min(NtrajList))  # Effective lines
+            state.umbInfo = umbBuffer[:, :state.Ntraj, :]
+            if changed and state.NtrajEff > 0:
+                print('[INFO] Refreshing figures: {} to {} trajectories'.format(state.NtrajEff, state.Ntraj))
+                renderFigures(state, [(plot_overlap, ()), (plot_overlap_evolution, ()), (plot_variance, ())] +
+                              PMFEvolutionJobs(state))
+            time.sleep(state.args.interval)
+    except KeyboardInterrupt:
+        print('[INFO] Stop watching. ')
+
+
+inputCache = {}  # (hash of the input file, temperature): InputInfo
+
+# The settings of the umbrella sampling in the input file, times in ps
+InputInfo = namedtuple('InputInfo', ['label', 'dt', 'evolutionTime', 'windows'])
+UmbrellaWindow = namedtuple('UmbrellaWindow', ['xi', 'kforce', 'trajectories', 'equilibrationTime', 'evolutionTime'])
+
+# The parameters of the RPMDrate functions read by `parseInput`, the calls of the others are skipped
+inputFunctions = {
+    'Window': ['xi', 'kforce', 'trajectories', 'equilibrationTime', 'evolutionTime'],
+    'generateUmbrellaConfigurations': ['dt', 'evolutionTime', 'xi_list', 'kforce'],
+    'conductUmbrellaSampling': ['dt', 'windows', 'saveTrajectories'],
+}
+# Bounds of the input file, so that a line like `9 ** 9 ** 9` or `range(10 ** 12)` fails instead of hanging
+maxInputItems = 10 ** 6  # elements of a sequence or an array
+maxInputIterations = 10 ** 6  # iterations of all the loops
+maxInputBits = 10 ** 4  # size of an integer
+
+
+def inputArange(*values, **keywords):
+    bounds = dict(zip(['start', 'stop', 'step'], values), **keywords)
+    if 'stop' not in bounds:
+        bounds['start'], bounds['stop'] = 0, bounds['start']
+    step = bounds.get('step', 1)
+    if step != 0 and np.ceil((bounds['stop'] - bounds['start']) / step) > maxInputItems:
+        raise InputLimitError('numpy.arange of more than {} elements'.format(maxInputItems))
+    return np.arange(*values, **keywords)
+
+
+def inputLinspace(*values, **keywords):
+    if (values[2] if len(values) > 2 else keywords.get('num', 50)) > maxInputItems:
+        raise InputLimitError('numpy.linspace of more than {} elements'.format(maxInputItems))
+    return np.linspace(*values, **keywords)
+
+
+inputBuiltins = {'numpy.arange': inputArange, 'numpy.linspace': inputLinspace, 'numpy.array': np.array,
+                 'numpy.concatenate': np.concatenate, 'numpy.append': np.append, 'numpy.round': np.round,
+                 'range': range, 'len': len, 'list': list, 'float': float, 'int': int, 'abs': abs, 'round': round,
+                 'min': min, 'max': max, 'enumerate': enumerate, 'zip': zip, 'sorted': sorted, 'reversed': reversed}
+inputConstants = {'numpy.pi': np.pi, 'numpy.e': np.e, 'numpy.inf': np.inf}
+inputOperators = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                  ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+                  ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_,
+                  ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                  ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+
+class InputError(ValueError):
+    pass
 
-        for j in range(Ntraj):
-            try:
-                line = f[15 + j].split()
-                if len(line) != 5:
-                    # print(f'{xi_list[i]} has wrong line! ')
-                    raise Exception
-                umbInfo[:, j, i] = line
-            except IndexError:
-                umbInfo[:, j, i] = None
-
-    return umbInfo
-
-
-def getInput(folder):
-    inputPath =inputFile
-
-    # skip `import PES`
-    f = open(inputPath, 'r')
-    start = 0
-    inputContent = ''
-    for i, line in enumerate(f.readlines()):
-        if line[:5] == 'label' or line[:5] == 'react':
-            start = 1
-        if start == 1:
-            inputContent += line.replace('numpy', 'np')
-
-    # execute the input.py and get force constant
-    T = temp
+
+class InputLimitError(InputError):
+    pass  # beyond the bounds of the input file, raised at once even by an assignment
+
+
+def inputFail(node, message):
+    raise InputError('line {}: {}'.format(getattr(node, 'lineno', '?'), message))
+
+
+def inputLimit(node, message):
+    raise InputLimitError('line {}: {}'.format(getattr(node, 'lineno', '?'), message))
+
+
+def checkInputSize(node, value):
+    """
+    Fail if `value`, computed at `node`, is beyond the bounds of the input file.
+    """
+    if isinstance(value, int) and value.bit_length() > maxInputBits:
+        inputLimit(node, 'integer of more than {} bits'.format(maxInputBits))
+    elif isinstance(value, (list, tuple, str, range)) and len(value) > maxInputItems:
+        inputLimit(node, 'sequence of more than {} elements'.format(maxInputItems))
+    elif isinstance(value, np.ndarray) and value.size > maxInputItems:
+        inputLimit(node, 'array of more than {} elements'.format(maxInputItems))
+    return value
+
+
+def binaryInput(node, left, right):
+    """
+    The binary operation `node` on `left` and `right`, checking the size of the powers and repetitions first.
+    """
+    op = type(node.op)
+    if op is ast.Pow and isinstance(left, int) and isinstance(right, int) and abs(left) > 1 and \
+            right * left.bit_length() > maxInputBits:
+        inputLimit(node, 'integer of more than {} bits'.format(maxInputBits))
+    if op is ast.Mult:
+        sequence, times = (left, right) if isinstance(left, (list, tuple, str)) else (right, left)
+        if isinstance(sequence, (list, tuple, str)) and isinstance(times, int) and \
+                len(sequence) * times > maxInputItems:
+            inputLimit(node, 'sequence of more than {} elements'.format(maxInputItems))
+    if op is ast.Add and isinstance(left, (list, tuple, str)) and isinstance(right, (list, tuple, str)) and \
+            len(left) + len(right) > maxInputItems:
+        inputLimit(node, 'sequence of more than {} elements'.format(maxInputItems))
+    if isinstance(left, np.ndarray) or isinstance(right, np.ndarray):
+        try:
+            size = np.prod(np.broadcast_shapes(np.shape(left), np.shape(right)), dtype=float)
+        except ValueError:
+            size = 0  # the operation fails by itself
+        if size > maxInputItems:
+            inputLimit(node, 'array of more than {} elements'.format(maxInputItems))
+    try:
+        return checkInputSize(node, inputOperators[op](left, right))
+    except OverflowError as e:
+        inputLimit(node, str(e))
+    except ArithmeticError as e:
+        inputFail(node, str(e))
+
+
+def countIteration(node, env):
+    env['<iterations>'][0] += 1  # not a valid name, shared by the copies of `env` of list comprehensions
+    if env['<iterations>'][0] > maxInputIterations:
+        inputLimit(node, 'more than {} loop iterations'.format(maxInputIterations))
+
+
+def timeInPs(value):
+    """
+    A time `(value, unit)` of the input file, or a number, in ps.
+    """
+    if not isinstance(value, tuple):
+        return float(value)
+    if value[1] == 'ps':
+        return float(value[0])
+    elif value[1] == 'fs':
+        return float(value[0]) * 1E-3
+    elif value[1] == 'ns':
+        return float(value[0]) * 1E3
+    print('[ERROR] Time unit {} not support and will be regarded as `ps`. '.format(value[1]))
+    return float(value[0])
+
+
+def bindArguments(node, name, values, keywords):
+    parameters = inputFunctions[name]
+    if len(values) > len(parameters) or any(key not in parameters for key in keywords):
+        inputFail(node, 'wrong arguments of {}'.format(name))
+    return dict(zip(parameters, values), **keywords)
+
+
+def evalInput(node, env):
+    """
+    Evaluate the expression `node` of the input file, with the names of `env`.
+    Only numbers, strings, tuples, lists, arithmetic, comparisons, `Window(...)`, a few numpy functions and
+    `list.append` are supported.
+    """
+    if isinstance(node, ast.Constant):
+        return node.value
+    elif isinstance(node, ast.Name):
+        if node.id not in env:
+            inputFail(node, 'name {!r} is not defined'.format(node.id))
+        if isinstance(env[node.id], InputError):
+            raise env[node.id]
+        return env[node.id]
+    elif isinstance(node, (ast.Tuple, ast.List)):
+        values = [evalInput(element, env) for element in node.elts]
+        return tuple(values) if isinstance(node, ast.Tuple) else values
+    elif isinstance(node, ast.BinOp) and type(node.op) in inputOperators:
+        return binaryInput(node, evalInput(node.left, env), evalInput(node.right, env))
+    elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in ('numpy', 'np') \
+            and 'numpy.' + node.attr in inputConstants:
+        return inputConstants['numpy.' + node.attr]
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in inputOperators:
+        return inputOperators[type(node.op)](evalInput(node.operand, env))
+    elif isinstance(node, ast.Compare) and all(type(op) in inputOperators for op in node.ops):
+        left = evalInput(node.left, env)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = evalInput(comparator, env)
+            if not inputOperators[type(op)](left, right):
+                return False
+            left = right
+        return True
+    elif isinstance(node, ast.BoolOp):
+        values = (evalInput(value, env) for value in node.values)
+        return all(values) if isinstance(node.op, ast.And) else any(values)
+    elif isinstance(node, ast.IfExp):
+        return evalInput(node.body if evalInput(node.test, env) else node.orelse, env)
+    elif isinstance(node, ast.Subscript):
+        return evalInput(node.value, env)[evalInput(node.slice, env)]
+    elif isinstance(node, ast.Slice):
+        return slice(*(evalInput(part, env) if part is not None else None
+                       for part in (node.lower, node.upper, node.step)))
+    elif isinstance(node, ast.ListComp) and len(node.generators) == 1:
+        generator, result = node.generators[0], []
+        for value in evalInput(generator.iter, env):
+            countIteration(node, env)
+            local = dict(env)
+            assignInput(generator.target, value, local)
+            if all(evalInput(condition, local) for condition in generator.ifs):
+                result.append(evalInput(node.elt, local))
+        return result
+    elif isinstance(node, ast.Call):
+        values = [evalInput(value, env) for value in node.args]
+        keywords = {keyword.arg: evalInput(keyword.value, env) for keyword in node.keywords}
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in ('numpy', 'np'):
+            name = 'numpy.' + func.attr
+        elif isinstance(func, ast.Attribute) and func.attr in ('append', 'extend') and not keywords:
+            target = evalInput(func.value, env)
+            if not isinstance(target, list):
+                inputFail(node, '{} of a {}'.format(func.attr, type(target).__name__))
+            getattr(target, func.attr)(*values)
+            checkInputSize(node, target)
+            return None
+        elif isinstance(func, ast.Name) and func.id not in env:
+            name = func.id
+        else:
+            inputFail(node, 'unsupported call')
+        if name == 'Window':
+            window = bindArguments(node, name, values, keywords)
+            return UmbrellaWindow(float(window['xi']), float(window['kforce']), window.get('trajectories'),
+                                  timeInPs(window.get('equilibrationTime', 0)),
+                                  timeInPs(window.get('evolutionTime', 0)))
+        if name not in inputBuiltins:
+            inputFail(node, 'unsupported function {}'.format(name))
+        try:
+            value = inputBuiltins[name](*values, **keywords)
+        except InputLimitError as e:  # from the bounds of numpy.arange and numpy.linspace
+            inputLimit(node, str(e))
+        return checkInputSize(node, value)
+    inputFail(node, 'unsupported expression {}'.format(type(node).__name__))
+
+
+def assignInput(target, value, env):
+    if isinstance(target, ast.Name):
+        env[target.id] = value
+    elif isinstance(target, (ast.Tuple, ast.List)):
+        values = list(value)
+        if len(values) != len(target.elts):
+            inputFail(target, 'cannot unpack {} values into {}'.format(len(values), len(target.elts)))
+        for element, value in zip(target.elts, values):
+            assignInput(element, value, env)
+    elif isinstance(target, ast.Subscript):
+        container = evalInput(target.value, env)
+        if not isinstance(container, (list, np.ndarray)):
+            inputFail(target, 'item assignment of a {}'.format(type(container).__name__))
+        container[evalInput(target.slice, env)] = value
+        checkInputSize(target, container)
+    else:
+        inputFail(target, 'unsupported assignment')
+
+
+def rootName(node):
+    """
+    The name `a` of an expression `a.b[c].d(e)`, or None.
+    """
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def inputTargets(node):
+    """
+    The names the statement `node` of the input file may bind or modify: its assignments, definitions, imports and
+    the objects of its method calls.
+    """
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    elif isinstance(node, (ast.Import, ast.ImportFrom)):
+        return {alias.asname or alias.name.split('.')[0] for alias in node.names}
+    elif isinstance(node, (ast.Global, ast.Nonlocal)):
+        return set(node.names)
+    elif isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        return set()  # their own scope
+    elif isinstance(node, ast.Name):
+        return {node.id} if not isinstance(node.ctx, ast.Load) else set()
+    names = set()
+    if isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load) or \
+            isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        names.add(rootName(node))
+    if isinstance(node, ast.ExceptHandler) and node.name:
+        names.add(node.name)
+    for child in ast.iter_child_nodes(node):
+        names |= inputTargets(child)
+    return names - {None}
+
+
+def callsInputFunctions(node):
+    return any(isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id in inputFunctions
+               and child.func.id != 'Window' for child in ast.walk(node))
+
+
+def execInput(body, env, calls):
+    """
+    Run the statements `body` of the input file on the names of `env`, keeping the arguments of the calls of
+    `inputFunctions` into `calls`. The other calls and the imports are skipped. The statements that cannot be
+    interpreted are skipped too, the names they bind or modify fail only if they are used, unless they call
+    `inputFunctions` or are beyond the bounds of the input file.
+    """
+    for node in body:
+        try:
+            execStatement(node, env, calls)
+        except InputLimitError:
+            raise
+        except (TypeError, ValueError, IndexError, KeyError, ArithmeticError) as e:
+            error = e if isinstance(e, InputError) else InputError('line {}: {}'.format(node.lineno, e))
+            if callsInputFunctions(node):
+                raise error
+            for name in inputTargets(node):
+                env[name] = error
+
+
+def execStatement(node, env, calls):
+    """
+    Run the statement `node` of the input file, see `execInput`.
+    """
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.Pass)):
+        return
+    elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+        func = node.value.func
+        if isinstance(func, ast.Name) and func.id in inputFunctions and func.id != 'Window':
+            values = [evalInput(value, env) for value in node.value.args]
+            keywords = {keyword.arg: evalInput(keyword.value, env) for keyword in node.value.keywords}
+            calls[func.id] = bindArguments(node.value, func.id, values, keywords)
+        elif isinstance(func, ast.Attribute) and func.attr in ('append', 'extend'):
+            evalInput(node.value, env)
+    elif isinstance(node, ast.Expr):
+        return  # docstrings
+    elif isinstance(node, ast.Assign):
+        value = evalInput(node.value, env)
+        for target in node.targets:
+            assignInput(target, value, env)
+    elif isinstance(node, ast.AugAssign) and type(node.op) in inputOperators:
+        assignInput(node.target, binaryInput(node, evalInput(node.target, env), evalInput(node.value, env)), env)
+    elif isinstance(node, ast.For) and not node.orelse:
+        for value in evalInput(node.iter, env):
+            countIteration(node, env)
+            assignInput(node.target, value, env)
+            execInput(node.body, env, calls)
+    elif isinstance(node, ast.If):
+        execInput(node.body if evalInput(node.test, env) else node.orelse, env, calls)
+    else:
+        inputFail(node, 'unsupported statement {}'.format(type(node).__name__))
+
+
+def parseInput(inputPath, T):
+    """
+    Read the umbrella sampling settings of the RPMDrate input file at temperature `T` without executing it:
+    the statements are interpreted from the syntax tree, see `execInput`. The result is cached by the content of
+    the file. Raise `InputError` if the file uses something not supported.
+    """
+    with open(inputPath, 'rb') as f:
+        content = f.read()
+    key = (hashlib.sha1(content).hexdigest(), T)
+    if key in inputCache:
+        return inputCache[key]
+
+    env = {'T': T, '<iterations>': [0]}
+    calls = {}
     try:
-        exec(inputContent)
-    except (NameError, TypeError, SyntaxError):
+        execInput(ast.parse(content, inputPath).body, env, calls)
+    except SyntaxError as e:
+        raise InputError('line {}: {}'.format(e.lineno, e.msg))
+    except (TypeError, ValueError, IndexError, KeyError, ArithmeticError, MemoryError) as e:
+        if isinstance(e, InputError):
+            raise
+        raise InputError(str(e))
+    if 'conductUmbrellaSampling' not in calls:
+        raise InputError('no conductUmbrellaSampling')
+    windows = calls['conductUmbrellaSampling']['windows']
+    if not all(isinstance(window, UmbrellaWindow) for window in windows):
+        raise InputError('the windows of conductUmbrellaSampling are not all Window(...)')
+
+    settings = calls.get('generateUmbrellaConfigurations', calls['conductUmbrellaSampling'])
+    label = env.get('label')
+    inputCache[key] = InputInfo(label if isinstance(label, str) else None, timeInPs(settings['dt']),
+                                timeInPs(settings['evolutionTime']) if 'evolutionTime' in settings else None,
+                                tuple(windows))
+    return inputCache[key]
+
+
+def getInput(state, folder):
+    inputPath =state.inputFile
+
+    # read the input.py and get force constant
+    try:
+        info = parseInput(inputPath, state.temp)
+    except (OSError, InputError):
         print('[ERROR] The input file {0!r} was invalid:'.format(inputPath))
         raise
 
-    global path
-    path = os.path.join(folder, str(args.T), str(Nbeads))
+    state.delta = info.dt
+    assert float(state.delta) < 1
+    state.xi_list = np.array(['{0:.8f}'.format(window.xi) for window in info.windows], dtype=float)
+    state.kforce_list = np.array([window.kforce for window in info.windows]) / state.temp
+
+    kf_path = os.path.join(os.path.abspath(os.path.dirname(state.figPath)), 'kforce.txt')
+    if os.path.exists(kf_path):
+        kf_list_read = open(kf_path, 'r')
+        kflines = kf_list_read.readlines()
+        for i, line in enumerate(kflines):
+            state.kforce_list[i] = float(line.split()[1])
+            # print('kforce: {}'.format(kforce_list[i]))
 
-    global mylabel
-    if Nbeads == 1:
-        mylabel = '{} K, {} bead'.format(temp, Nbeads)
+    state.path = os.path.join(folder, str(state.args.T), str(state.Nbeads))
+
+    if state.Nbeads == 1:
+        state.mylabel = '{} K, {} bead'.format(state.temp, state.Nbeads)
     else:
-        mylabel = '{} K, {} beads'.format(temp, Nbeads)
-    global myticks
-    myticks = []
-    for i in range(len(xi_list)):
-        xi = xi_list[i]
+        state.mylabel = '{} K, {} beads'.format(state.temp, state.Nbeads)
+    state.myticks = []
+    for i in range(len(state.xi_list)):
+        xi = state.xi_list[i]
         m = np.abs(np.mod(xi, 0.1))
         epsilon = 1e-6
         if m < epsilon or m > 0.1 - epsilon:
-            myticks.append(xi)
+            state.myticks.append(xi)
 
 
-def getRate(path):
+def getRate(state):
     print('[INFO] rate coefficients: ')
-    fileList = os.listdir(path)
+    fileList = os.listdir(state.path)
     rateFile = ''
     for file in fileList:
         if file.split('_')[0] == 'rate':
-            rateFile = os.path.join(path, file)
+            rateFile = os.path.join(state.path, file)
             break
 
     if len(rateFile) == 0:
         print('[INFO] No rate file. ')
-        return
+        return None
 
     f = open(rateFile, 'r')
-    g = open(os.path.join(figPath, 'my_rate.txt'), 'w')
+    g = open(os.path.join(state.figPath, 'my_rate.txt'), 'w')
     fl = f.readlines()
 
     rateTemp = float(fl[4].split()[-2])
@@ -1341,110 +2212,743 @@ def getRate(path):
     f.close()
     g.close()
 
-    return
-
-# Defination in RPMDrate:
-def reactants(atoms, reactant1Atoms, reactant2Atoms, Rinf):
-    pass
-
+    return {'T': rateTemp, 'xi': rateMaxxi, 'deltaG': rateFreeEnergy * 627.509474063056, 'kQTST': rateQTST,
+            'kappa': rateRex, 'kRPMD': rateRPMD, 'kRPMDfT': rateRPMDfT}
+
+
+def saveResults(state, rate=None):
+    """
+    Save the computed quantities of the task into the archive `results.npz` in the figure folder,
+    to be loaded with `np.load` without parsing any text file:
+    `xi_list`, `kforce`: the windows;
+    `umbrella_time` (ps), `umbrella_mean`, `umbrella_var`: the statistics of each (cycle, window), NaN beyond the end;
+    `overlap_xi`, `overlap_evolution`: the overlap ratio of adjacent windows at each cycle;
+    `pmf_xi`, `pmf`: the PMF of RPMDrate (kcal/mol);
+    `pmf_evolution_time`, `pmf_evolution_xi`, `pmf_evolution`: the PMF at each cycle (kcal/mol);
+    `free_energy`: the (time, xi, free energy) of the PMF maximum at each cycle, refined between the bins;
+    `kappa_time` (fs), `kappa`: the transmission coefficient;
+    `rate_*`: the summary of `my_rate.txt`.
+    The entries whose data is not available are left out.
+    """
+    results = {'T': state.temp, 'Nbeads': int(state.Nbeads), 'xi_list': state.xi_list,
+               'kforce': state.kforce_list * state.temp, 'umbrella_time': umbColumn(state, 2) * state.delta,
+               'umbrella_mean': umbColumn(state, 3), 'umbrella_var': umbColumn(state, 4),
+               'overlap_xi': (state.xi_list[:-1] + state.xi_list[1:]) / 2, 'overlap_evolution': overlapEvolution(state)}
+
+    pmf = readPMF(state.path)
+    if pmf is not None:
+        results['pmf_xi'], results['pmf'] = pmf
+
+    if state.NtrajEff > 1:
+        PMFdata, times, xi = openPMFStore(state)
+        results['pmf_evolution_time'], results['pmf_evolution_xi'] = times, xi
+        results['pmf_evolution'] = PMFdata
+        with np.load(os.path.join(state.figPath, 'PMF_evolution_axes.npz')) as axes:
+            results['free_energy'] = axes['free_energy']
+
+    kappa = readRecrossing(state.path)
+    if kappa is not None:
+        results['kappa_time'], results['kappa'] = kappa
+
+    for key, value in (rate or {}).items():
+        results['rate_' + key] = value
+
+    fname = outputPath(state, 'results.npz')
+    with open(fname + '.tmp', 'wb') as f:
+        np.savez(f, **results)
+    os.replace(fname + '.tmp', fname)
+    print('[INFO] Results saved into {}'.format(fname))
+
+
+workerState = None  # the task of a plotting worker process, see `initWorker`
+
+
+def initWorker(shmName, shape, dtype, state):
+    global workerState
+    workerState = state
+    workerState.umbShm = shared_memory.SharedMemory(name=shmName)
+    workerState.umbInfo = np.ndarray(shape, dtype=dtype, buffer=workerState.umbShm.buf)
+
+
+def runJob(state, func, funcArgs, stage=None):
+    """
+    Run the job `func(state, *funcArgs)` and return the outputs it saved through `outputPath` and its profile records.
+    """
+    state.savedFiles.clear()
+    start = len(state.profileRecords)
+    with profileStage(state, stage or func.__name__):
+        func(state, *funcArgs)
+    records = state.profileRecords[start:]
+    del state.profileRecords[start:]
+    return list(state.savedFiles), records
+
+
+def runWorkerJob(func, funcArgs, stage=None):
+    return runJob(workerState, func, funcArgs, stage)
+
+
+def resetPeakMemory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:  # Linux only
+            f.write('5')
+    except OSError:
+        pass
 
-def transitionState(geometry, formingBonds, breakingBonds):
-    pass
 
+def peakMemory():
+    """
+    The peak resident memory (MB) of the process since `resetPeakMemory`, or since it started if that is not supported.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 1024)
+
+
+@contextlib.contextmanager
+def profileStage(state, stage):
+    """
+    Record the wall time, CPU time, savefig time and peak memory of `stage` if `--profile` is given.
+    """
+    if not state.args.profile:
+        yield
+        return
+    state.savefigTime[:] = 0., 0.
+    resetPeakMemory()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        savefigWall, savefigCPU = state.savefigTime
+        state.profileRecords.append({'stage': stage, 'pid': os.getpid(), 'wall': wall, 'cpu': cpu,
+                                     'compute_wall': wall - savefigWall, 'compute_cpu': cpu - savefigCPU,
+                                     'savefig_wall': savefigWall, 'savefig_cpu': savefigCPU,
+                                     'peak_MB': peakMemory()})
+
+
+@contextlib.contextmanager
+def savefigTimer(state):
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        state.savefigTime[0] += time.perf_counter() - wall
+        state.savefigTime[1] += time.process_time() - cpu
+
+
+def writeProfile(state, totalWall):
+    """
+    Write the profile records into `profile.json`, with the task and the versions, and `profile.csv`
+    in the figure folder, and print them as a table.
+    """
+    columns = ['stage', 'pid', 'wall', 'cpu', 'compute_wall', 'compute_cpu', 'savefig_wall', 'savefig_cpu', 'peak_MB']
+    task = {'T': state.args.T, 'Nbeads': state.args.N, 'windows': len(state.xi_list), 'Ntraj': state.Ntraj,
+            'NtrajEff': state.NtrajEff, 'bins': state.args.bins, 'jobs': state.args.jobs, 'frames': state.args.frames,
+            'wall': totalWall,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'matplotlib': matplotlib.__version__}
+    with open(os.path.join(state.figPath, 'profile.json'), 'w') as f:
+        json.dump({'task': task, 'stages': state.profileRecords}, f, indent=1)
+    with open(os.path.join(state.figPath, 'profile.csv'), 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for record in state.profileRecords:
+            f.write(','.join(str(record[column]) for column in columns) + '\n')
+
+    print('[INFO] Profile (seconds, MB), also in profile.json and profile.csv: ')
+    print('       {:<32s}{:>9s}{:>9s}{:>9s}{:>9s}{:>9s}'.format('stage', 'wall', 'cpu', 'compute', 'savefig', 'peak'))
+    for record in sorted(state.profileRecords, key=lambda record: -record['wall']):
+        print('       {:<32s}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.1f}'.format(
+            record['stage'][:31], record['wall'], record['cpu'], record['compute_wall'], record['savefig_wall'],
+            record['peak_MB']))
+    print('       {:<32s}{:>9.2f}'.format('total', totalWall))
+
+
+def loadBuildState(state):
+    try:
+        with open(os.path.join(state.figPath, 'build_state.json'), 'r') as f:
+            state.buildState = json.load(f)
+    except (OSError, ValueError):
+        state.buildState = {}
+
+
+def saveBuildState(state):
+    fname = os.path.join(state.figPath, 'build_state.json')
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state.buildState, f, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+
+@functools.lru_cache(maxsize=None)
+def usedFunctions(func):
+    """
+    The functions of this script named in the code of `func`.
+    """
+    names = [node.id for node in ast.walk(ast.parse(textwrap.dedent(inspect.getsource(func))))
+             if isinstance(node, ast.Name)]
+    return tuple(func.__globals__[name] for name in dict.fromkeys(names) if inspect.isfunction(
+        func.__globals__.get(name)) and func.__globals__[name].__globals__ is func.__globals__)
+
+
+def calledFunctions(funcs):
+    """
+    The functions `funcs` and the functions of this script they use, directly or through each other.
+    """
+    found = {}
+    stack = list(reversed(funcs))
+    while stack:
+        func = stack.pop()
+        if func not in found:
+            found[func] = None
+            stack.extend(reversed(usedFunctions(func)))
+    return list(found)
+
+
+def buildSignature(state, funcs, inputs, extra=()):
+    """
+    The signature of an output: the source code of the functions computing it and of the functions they use,
+    the parameters of the task, the fingerprints of its input files and `extra`.
+    """
+    sha = hashlib.sha1()
+    for func in calledFunctions(funcs):
+        sha.update(inspect.getsource(func).encode())
+    parameters = [state.args.T, state.args.N, state.temp, state.delta, state.mylabel, state.xi_list.tolist(),
+                  state.kforce_list.tolist()]
+    fingerprints = [fileFingerprint(fname) if os.path.exists(fname) else None for fname in inputs]
+    sha.update(repr((parameters, fingerprints, extra)).encode())
+    return sha.hexdigest()
+
+
+def jobInputs(state, func):
+    """
+    The input files of the plotting function `func`.
+    """
+    if func is plot_pmf:
+        return [os.path.join(state.path, 'potential_of_mean_force.dat')]
+    elif func is plot_rexFactor:
+        return [os.path.join(state.path, file) for file in sorted(os.listdir(state.path))
+                if file[:18] == 'recrossing_factor_']
+    elif func in (plot_free_energy, plot_PMF_3D, plot_PMF_frame):
+        return [os.path.join(state.figPath, name) for name in ('PMF_evolution.npy', 'PMF_evolution_axes.npz')]
+    elif func is plotKForce:
+        return []
+    return umbrellaFiles(state)
+
+
+# The helpers reading the umbrella data, in the signature of every output computed from it: the plotting functions
+# only use the data loaded by them
+dataHelpers = [readUmbrellaFile, umbColumn, raggedToDense]
+
+
+def jobSignature(state, func):
+    return buildSignature(state, [func] + dataHelpers, jobInputs(state, func))
+
+
+def upToDate(state, key, signature):
+    """
+    Whether the outputs of `key` were built with `signature` and are all still there.
+    """
+    entry = state.buildState.get(key)
+    return (entry is not None and entry['signature'] == signature and
+            all(os.path.exists(os.path.join(state.figPath, name)) for name in entry['outputs']))
+
+
+def recordBuild(state, key, signature, outputs):
+    state.buildState[key] = {'signature': signature, 'outputs': outputs}
+    saveBuildState(state)
+
+
+plotLock = threading.RLock()  # pyplot is not thread-safe: the figures rendered in this process, one task at a time
+
+
+def renderFigures(state, jobs):
+    """
+    Run the plotting `jobs` of the task `state`, a list of (function, arguments), in `--jobs` worker processes.
+    The plotting functions only read the loaded data, so the workers share one copy of `umbInfo`.
+    With `--incremental`, the jobs whose outputs are up to date are skipped.
+    """
+    keys = ['{}{}'.format(func.__name__, tuple(funcArgs)) if func is not plot_free_energy else func.__name__
+            for func, funcArgs in jobs]
+    signatures = [jobSignature(state, func) for func, funcArgs in jobs]
+    if state.args.incremental:
+        todo = [i for i, key in enumerate(keys) if not upToDate(state, key, signatures[i])]
+        if len(todo) < len(jobs):
+            print('[INFO] {} of {} figures are up to date. '.format(len(jobs) - len(todo), len(jobs)))
+        jobs = [jobs[i] for i in todo]
+        keys = [keys[i] for i in todo]
+        signatures = [signatures[i] for i in todo]
+
+    if state.args.jobs <= 1 or len(jobs) <= 1:
+        try:
+            with plotLock:
+                for i, (func, funcArgs) in enumerate(jobs):
+                    outputs, records = runJob(state, func, funcArgs, keys[i])
+                    state.buildState[keys[i]] = {'signature': signatures[i], 'outputs': outputs}
+                    uploadFiles(state, outputs)
+                    state.profileRecords.extend(records)
+        finally:
+            saveBuildState(state)
+        return
 
-def equivalentTransitionState(formingBonds, breakingBonds):
-    pass
+    shm = shared_memory.SharedMemory(create=True, size=max(state.umbInfo.nbytes, 1))
+    try:
+        np.ndarray(state.umbInfo.shape, dtype=state.umbInfo.dtype, buffer=shm.buf)[:] = state.umbInfo
+        with ProcessPoolExecutor(max_workers=state.args.jobs, initializer=initWorker,
+                                 initargs=(shm.name, state.umbInfo.shape, state.umbInfo.dtype.str,
+                                           state.shared())) as pool:
+            futures = [pool.submit(runWorkerJob, func, funcArgs, keys[i])
+                       for i, (func, funcArgs) in enumerate(jobs)]
+            for i, future in enumerate(futures):
+                outputs, records = future.result()
+                state.buildState[keys[i]] = {'signature': signatures[i], 'outputs': outputs}
+                uploadFiles(state, outputs)
+                state.profileRecords.extend(records)
+    finally:
+        shm.close()
+        shm.unlink()
+        saveBuildState(state)
+
+
+def coscmdUpload(fname, key, target):
+    """
+    Upload through `coscmd`, into the bucket of its configuration (`target` is unused).
+    """
+    result = subprocess.run(['coscmd', 'upload', fname, key], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True)
+    if result.returncode != 0:
+        raise OSError(result.stderr.strip() or 'coscmd exited with {}'.format(result.returncode))
+
+
+def localUpload(fname, key, target):
+    """
+    Copy into the folder `target`, e.g. a mounted storage, or for testing.
+    """
+    dest = os.path.join(target, *key.split('/'))
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copyfile(fname, dest + '.part')
+    os.replace(dest + '.part', dest)
+
+
+# `--upload name:target` uploads each file by calling uploadBackends[name](fname, key, target)
+uploadBackends = {'coscmd': coscmdUpload, 'local': localUpload}
+
+
+def uploadWithRetry(state, backend, fname, key, target):
+    """
+    Upload the file, retrying with an increasing delay. Return the number of retries.
+    """
+    for attempt in range(state.args.uploadRetries + 1):
+        try:
+            backend(fname, key, target)
+            return attempt
+        except FileNotFoundError:
+            raise
+        except Exception:
+            if attempt == state.args.uploadRetries:
+                raise
+            time.sleep(min(2 ** attempt, 30))
+
+
+def fileHash(fname):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def uploadIfChanged(state, backend, fname, key, target, previous):
+    """
+    Upload the file unless its content is the one of `previous`, its entry in the manifest of the last run.
+    The file is only hashed again if its size or modification time changed.
+    Return its entry in the new manifest and the number of retries (None if it was not uploaded).
+    """
+    size, mtime = fileFingerprint(fname)
+    if previous is not None and [previous['size'], previous['mtime_ns']] == [size, mtime]:
+        sha = previous['sha256']
+    else:
+        sha = fileHash(fname)
+    if previous is not None and previous['sha256'] == sha:
+        return dict(previous, size=size, mtime_ns=mtime), None
+    retries = uploadWithRetry(state, backend, fname, key, target)
+    return {'size': size, 'mtime_ns': mtime, 'sha256': sha, 'key': key}, retries
 
 
-def thermostat(type, **kwargs):
-    pass
+def submitUpload(state, fname, section, name):
+    name = name.replace(os.sep, '/')
+    if section + '/' + name in state.uploadFutures:
+        return
+    backend, _, target = state.args.upload.partition(':')
+    state.uploadFutures[section + '/' + name] = state.uploadPool.submit(
+        uploadIfChanged, state, uploadBackends[backend], fname, state.uploadPrefix[section] + name, target,
+        state.uploadManifest.get(section + '/' + name))
 
 
-def generateUmbrellaConfigurations(dt, evolutionTime, xi_list, kforce):
-    global delta
-    if dt[1] == 'ps':
-        delta = dt[0]
-    elif dt[1] == 'fs':
-        delta = dt[0] * 1E-3
-    else:
-        print('[ERROR] Time unit {} not support and will be regarded as `ps`. '.format(dt[1]))
-        delta = dt[0]
-    assert float(delta) < 1
-
-def conductUmbrellaSampling(dt, windows, saveTrajectories=False):
-    global xi_list, kforce_list
-    # print(windows)
-    xi_list = np.zeros(len(windows))
-    kforce_list = np.zeros(len(windows))
-    for i in range(len(windows)):
-        xi_list[i] = '{0:.8f}'.format(windows[i][0])
-        kforce_list[i] = windows[i][1] / temp
-
-    kf_path = os.path.join(os.path.abspath(os.path.dirname(figPath)), 'kforce.txt')
-    if os.path.exists(kf_path):
-        kf_list_read = open(kf_path, 'r')
-        kflines = kf_list_read.readlines()
-        for i, line in enumerate(kflines):
-            kforce_list[i] = float(line.split()[1])
-            # print('kforce: {}'.format(kforce_list[i]))
-    return xi_list, kforce_list
-
-def computePotentialOfMeanForce(windows=None, xi_min=None, xi_max=None, bins=5000):
-    pass
+def uploadFiles(state, names):
+    """
+    Start uploading the outputs `names` of the figure folder, as soon as they are written.
+    """
+    if state.uploadPool is None:
+        return
+    for name in names:
+        submitUpload(state, os.path.join(state.figPath, name), 'fig', name)
+
+
+def uploadFolder(state, folder, section):
+    """
+    Start uploading the files of `folder` that are not uploaded yet.
+    """
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for file in sorted(files):
+            if not file.endswith('.tmp') and file != 'upload_manifest.json':
+                fname = os.path.join(root, file)
+                submitUpload(state, fname, section, os.path.relpath(fname, folder))
+
+
+def loadUploadManifest(state):
+    """
+    The files uploaded by the last run with the same backend, {name: {size, mtime_ns, sha256, key}}.
+    """
+    try:
+        with open(os.path.join(state.figPath, 'upload_manifest.json'), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest['files'] if manifest.get('backend') == state.args.upload else {}
+
+
+def finishUploads(state):
+    """
+    Wait for the uploads, write the manifest of the files uploaded or unchanged into `upload_manifest.json`
+    and upload it next to the figures, so that it gives the key holding the content of every file of the run.
+    Return the numbers of files uploaded, unchanged, retried and failed.
+    """
+    files = {}
+    uploaded, unchanged, retried, failed = 0, 0, 0, 0
+    for name, future in state.uploadFutures.items():
+        if future.cancelled():
+            continue
+        try:
+            files[name], retries = future.result()
+        except Exception as e:
+            failed += 1
+            print('[WARNING] Failed to upload {}: {}'.format(name, e))
+            continue
+        if retries is None:
+            unchanged += 1
+        else:
+            uploaded += 1
+            retried += retries > 0
+
+    fname = os.path.join(state.figPath, 'upload_manifest.json')
+    with open(fname + '.tmp', 'w') as f:
+        json.dump({'backend': state.args.upload, 'prefix': state.uploadPrefix,
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'files': files}, f, indent=1)
+    os.replace(fname + '.tmp', fname)
+    backend, _, target = state.args.upload.partition(':')
+    try:
+        uploadWithRetry(state, uploadBackends[backend], fname, state.uploadPrefix['fig'] + 'upload_manifest.json',
+                        target)
+    except Exception as e:
+        print('[WARNING] Failed to upload upload_manifest.json: {}'.format(e))
+    return uploaded, unchanged, retried, failed
+
+
+@contextlib.contextmanager
+def uploadSession(state):
+    """
+    Upload the figures and data of the task `state` with `--upload-jobs` concurrent transfers while it is processed:
+    the data folder at once, each output as soon as its job is done, and the rest of the figure folder at the end.
+    Only the files whose content changed since the last run are transferred, see `uploadIfChanged`.
+    If the task fails, the pending uploads are cancelled.
+    """
+    name = state.args.upload.partition(':')[0]
+    if name == 'none':
+        yield
+        return
+    if name not in uploadBackends:
+        raise ValueError('unknown upload backend {}, expected one of {} or none'.format(
+            name, ', '.join(uploadBackends)))
+    if name == 'coscmd' and shutil.which('coscmd') is None:
+        print('[WARNING] coscmd not found, nothing will be uploaded. ')
+        yield
+        return
 
+    dirload = os.getcwd().split("/")[-1]
+    time_str = time.strftime('%Y-%m-%d-%H_%M', time.localtime(time.time()))
+    task = '{}_{}'.format(state.args.T, state.args.N)
+    state.uploadPrefix['fig'] = 'RPMD_fig/{}/{}/{}/'.format(dirload, time_str, task)
+    state.uploadPrefix['data'] = 'RPMD_data/{}/{}/{}/'.format(dirload, time_str, task)
+    state.uploadManifest = loadUploadManifest(state)
+    state.uploadFutures.clear()
+    state.uploadPool = ThreadPoolExecutor(max_workers=max(state.args.uploadJobs, 1))
+    try:
+        uploadFolder(state, state.path, 'data')
+        yield
+    except BaseException:
+        state.uploadPool.shutdown(wait=True, cancel_futures=True)
+        state.uploadPool = None
+        finishUploads(state)  # keep what was uploaded
+        raise
 
-def computeRecrossingFactor(dt, equilibrationTime, childTrajectories, childSamplingTime, childrenPerSampling,
-                            childEvolutionTime, xi_current=None, saveParentTrajectory=False,
-                            saveChildTrajectories=False):
-    pass
+    uploadFolder(state, state.figPath, 'fig')
+    waitTime = time.perf_counter()
+    state.uploadPool.shutdown()
+    state.uploadPool = None
+    uploaded, unchanged, retried, failed = finishUploads(state)
+    print('[INFO] {} files uploaded ({} retried), {} unchanged, {} failed, waited {:.1f} s after the last output. '
+          .format(uploaded, retried, unchanged, failed, time.perf_counter() - waitTime))
+
+def discoverTasks(root):
+    """
+    All the (temperature, number of beads) folders `root/T/Nbeads` containing umbrella sampling files.
+    """
+    tasks = []
+    for T in os.listdir(root):
+        if not os.path.isdir(os.path.join(root, T)):
+            continue
+        for N in os.listdir(os.path.join(root, T)):
+            taskPath = os.path.join(root, T, N)
+            if os.path.isdir(taskPath) and \
+                    any(file.startswith('umbrella_sampling_') for file in os.listdir(taskPath)):
+                tasks.append((T, N))
+    # numbers in numerical order, then the others
+    return sorted(tasks, key=lambda task: [(0, float(x), '') if x.replace('.', '', 1).isdigit() else (1, 0., x)
+                                           for x in task])
+
+
+def runBatchTask(inputFolder, T, N, options):
+    """
+    Run one task of the batch with the command line `options`, with its output in `log.txt` of its figure folder.
+    Return the error message, or None if it succeeded.
+    """
+    options.T, options.N = T, N
+    logPath = os.path.join(inputFolder, str(T) + "_" + str(N))
+    os.makedirs(logPath, exist_ok=True)
+    with open(os.path.join(logPath, 'log.txt'), 'w') as log, contextlib.redirect_stdout(log), \
+            contextlib.redirect_stderr(log):
+        try:
+            runTask(TaskState(options), inputFolder)
+        except Exception:
+            traceback.print_exc(file=log)
+            return traceback.format_exc().strip().split('\n')[-1]
+    return None
+
+
+def runBatch(inputFolder, args):
+    """
+    Run all the tasks of `inputFolder` with the command line `args` and return the number of failed ones.
+    """
+    tasks = discoverTasks(inputFolder)
+    print('[INFO] Batch of {} tasks: {}'.format(len(tasks), ', '.join('{}/{}'.format(T, N) for T, N in tasks)))
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=args.tasks) as pool:
+        futures = {pool.submit(runBatchTask, inputFolder, T, N, args): (T, N) for T, N in tasks}
+        startTime = time.time()
+        for future in as_completed(futures):
+            T, N = futures[future]
+            try:
+                results[T, N] = future.result(), time.time() - startTime
+            except Exception as e:  # the worker process died
+                results[T, N] = repr(e), time.time() - startTime
+            print('       {}/{} {} after {:.1f} s'.format(T, N, 'done' if results[T, N][0] is None else 'FAILED',
+                                                         results[T, N][1]))
+
+    print('[INFO] Batch summary (logs in `T_Nbeads/log.txt`): ')
+    print('       T\tNbeads\tstatus')
+    for T, N in tasks:
+        error = results[T, N][0]
+        print('       {}\t{}\t{}'.format(T, N, 'ok' if error is None else 'FAILED: ' + error))
+    failed = sum(results[task][0] is not None for task in tasks)
+    print('       {} succeeded, {} failed'.format(len(tasks) - failed, failed))
+    return failed
+
+
+def openTask(state, inputFolder):
+    """
+    Set the figure folder, the basic information and the input of the task `state`, of temperature `args.T` and
+    `args.N` beads, and load its build state.
+    """
+    state.figPath = os.path.join(inputFolder, str(state.args.T)+"_"+str(state.args.N))
+    if not os.path.exists(state.figPath):
+        os.mkdir(state.figPath)
 
+    # get info
+    with profileStage(state, 'getBasicInfo'):
+        getBasicInfo(state, inputFolder)
+    with profileStage(state, 'getInput'):
+        getInput(state, inputFolder)
+    loadBuildState(state)
+
+
+def taskJobs(state):
+    """
+    The plotting jobs of a task, the PMF evolution is computed here and its figures are rendered with the others.
+    """
+    return (PMFEvolutionJobs(state, state.args.pmf3D) +
+            [(plotKForce, ()),
+             (plot_overlap, ()),
+             (plot_overlap_evolution, ()),
+             (plot_variance, ()),
+             (plot_variance_diff, ()),
+             (plot_pmf, (state.path,)),
+             (plot_rexFactor, (state.path,)),
+             (plot_xi, ()),
+             (plot_deviation, ())] +
+            ([(plot_var_evolution, (state.args.variances,))] if state.args.variances != 'none' else []))
+
+
+def processTask(state, startTime):
+    """
+    Plot the figures and save the results of the loaded task `state`.
+    """
+    with profileStage(state, 'getRate'):
+        rate = getRate(state)
 
-def computeRateCoefficient():
-    pass
+    # # plot
+    renderFigures(state, taskJobs(state))
+    inputs = (umbrellaFiles(state) + jobInputs(state, plot_pmf) + jobInputs(state, plot_rexFactor) +
+              jobInputs(state, plot_PMF_frame))
+    signature = buildSignature(state, [saveResults] + dataHelpers, inputs, rate)
+    if not (state.args.incremental and upToDate(state, 'saveResults', signature)):
+        outputs, records = runJob(state, saveResults, (rate,))
+        recordBuild(state, 'saveResults', signature, outputs)
+        uploadFiles(state, outputs)
+        state.profileRecords.extend(records)
+    if state.args.profile:
+        writeProfile(state, time.perf_counter() - startTime)
+
+
+def runTask(state, inputFolder):
+    """
+    Post-process the task `state`, of temperature `args.T` and `args.N` beads.
+    """
+    state.profileRecords.clear()
+    startTime = time.perf_counter()
+
+    openTask(state, inputFolder)
+    if state.args.watch:
+        watchUmbrellaInfo(state)
+        return
+    if state.args.shard:
+        with profileStage(state, 'getUmbrellaInfo'):
+            getUmbrellaInfo(state)
+        computePMFShard(state, state.args.shard)
+        return
+    with uploadSession(state):
+        with profileStage(state, 'getUmbrellaInfo'):
+            getUmbrellaInfo(state)
+        processTask(state, startTime)
+    # os.system("coscmd upload -r tra/ RPMD_tra/%s/%s_%s/ -H \"{'x-cos-meta-trajectory':'%i','x-cos-meta-evolution_time','%i'}\" "%(time_str,args.T,args.N,NtrajEff,20))
+    # plot_var_evolution()
+    # plot_overlap_density(path)
 
 
-def Window(xi, kforce, trajectories, equilibrationTime, evolutionTime):
-    return [float(xi), float(kforce)]
+class Task:
+    """
+    A task of temperature `T` and `N` beads in the RPMDrate folder `root` (with `inputFile` relative to it), loaded
+    once and analysed through its methods, e.g. from a notebook: `Task('./', 300, 4, bins=500).computePMFEvolution()`.
+    The options are the ones of the command line by their `dest` (`bins`, `compact`, `jobs`, `frames`, ...),
+    and nothing is uploaded unless `upload` is given.
+    Each task keeps its own `TaskState`, so several tasks can be used from several threads; only the rendering of
+    the figures with pyplot, which is not thread-safe, runs one task at a time.
+    """
+
+    def __init__(self, root, T, N, inputFile='input.py', **options):
+        self.inputFolder = os.path.join(root, '')
+        options.setdefault('upload', 'none')
+        taskArgs = parser.parse_args([])
+        taskArgs.T, taskArgs.N, taskArgs.I, taskArgs.R = str(T), str(N), os.path.join(root, inputFile), root
+        for name, value in options.items():
+            if not hasattr(taskArgs, name):
+                raise TypeError('unknown option {!r}'.format(name))
+            setattr(taskArgs, name, value)
+
+        self.state = TaskState(taskArgs)
+        openTask(self.state, self.inputFolder)
+        with profileStage(self.state, 'getUmbrellaInfo'):
+            getUmbrellaInfo(self.state)
+
+    def __getattr__(self, name):
+        # the state of the task: xi_list, kforce_list, umbInfo, NtrajEff, figPath, path, ...
+        if 'state' in self.__dict__ and hasattr(self.state, name):
+            return getattr(self.state, name)
+        raise AttributeError(name)
+
+    def call(self, func, *funcArgs):
+        """
+        Call the module function `func` on this task.
+        """
+        return func(self.state, *funcArgs)
+
+    def rate(self):
+        return getRate(self.state)
+
+    def computePMFEvolution(self):
+        """
+        Compute the PMF evolution into the figure folder and return the bins and the (time, xi, free energy) of the
+        maximum at each cycle. The PMF figures of the former evolution are deleted.
+        """
+        clearFolder(self.state, 'PMF')
+        return computePMFEvolution(self.state)
+
+    def PMFEvolution(self):
+        """
+        The PMF at each cycle (kcal/mol, memory-mapped), its times and its xi, see `openPMFStore`.
+        """
+        return openPMFStore(self.state)
+
+    def overlapEvolution(self):
+        return overlapEvolution(self.state)
+
+    def saveResults(self):
+        saveResults(self.state, getRate(self.state))
+
+    def plot(self, *jobs):
+        """
+        Render the figures of `jobs`, plotting functions or (function, arguments), e.g. `task.plot(plot_overlap)`.
+        """
+        renderFigures(self.state, [job if isinstance(job, tuple) else (job, ()) for job in jobs])
+
+    def run(self):
+        """
+        Plot all the figures and save the results, as the command line does.
+        """
+        self.state.profileRecords.clear()
+        with uploadSession(self.state):
+            processTask(self.state, time.perf_counter())
 
 
 def main(inputFolder=None):
+    args = parser.parse_args()
     # if inputFolder == None:
     #     inputFolder = input_path()
     inputFolder=args.R
     if inputFolder[-1]!="/":
         inputFolder+="/"
-    global figPath
-    figPath = os.path.join(inputFolder, str(args.T)+"_"+str(args.N))
-    if not os.path.exists(figPath):
-        os.mkdir(figPath)
 
-    # get info
-    getBasicInfo(inputFolder)
-    getInput(inputFolder)
-    getUmbrellaInfo(path)
-    getRate(path)
+    if args.bins < 2:
+        parser.error('--bins must be at least 2')
 
-    # # plot
-    plotKForce()
-    plot_overlap()
-    plot_variance()
-    plot_variance_diff()
-    plot_pmf(path)
-    plot_rexFactor(path)
-    plot_xi()
-    plot_deviation()
-
-    plot_PMF_evolution()
-    import time
-    # import os
-    dirload=os.getcwd().split("/")[-1]
-    time_str=time.strftime('%Y-%m-%d-%H_%M',time.localtime(time.time()))
-    os.system("coscmd upload -r %s/ RPMD_fig/%s/%s/%s_%s/  "%(figPath,dirload,time_str,args.T,args.N))
-    os.system("coscmd upload -r %s/ RPMD_data/%s/%s/%s_%s/ "%(path,dirload,time_str,args.T,args.N))
-    # os.system("coscmd upload -r tra/ RPMD_tra/%s/%s_%s/ -H \"{'x-cos-meta-trajectory':'%i','x-cos-meta-evolution_time','%i'}\" "%(time_str,args.T,args.N,NtrajEff,20))
-    # plot_var_evolution()
-    # plot_overlap_density(path)
-main()
+    if args.batch:
+        if runBatch(inputFolder, args) > 0:
+            sys.exit(1)
+    else:
+        runTask(TaskState(args), inputFolder)
+
+
+if __name__ == '__main__':
+    main()
 
 # root = r'C:\Users\Mike\Desktop\fin-OD-300_2'
 # for dir in os.listdir(root):
@@ -0,0 +1,229 @@
+'''
+Write a synthetic RPMDrate task that Post-RPMDrate can process:
+`input.py` in `root`, and in `root/T/Nbeads` the umbrella sampling files `umbrella_sampling_*.dat`,
+`potential_of_mean_force.dat`, `recrossing_factor_*.dat` and `rate_*.dat`.
+The umbrella windows sample a model barrier W(xi) = barrier * exp(-(xi - 1)^2 / (2 * width^2)),
+with each cycle a block average of `samples` independent samples, so that the PMF of the windows recovers the model.
+[Usage]
+run `python generate_dataset.py root --windows 110 --cycles 100` (see `-h` for the other parameters)
+'''
+import argparse
+import os
+
+import numpy as np
+
+hartree2kcal = 627.509474063056
+hartree2eV = 27.211386245988
+kB = 1.3806504E-23 / 4.35974417e-18  # Hartree/K
+
+
+def modelPMF(xi, barrier, width):
+    """
+    The model PMF (Hartree) and its first and second derivatives.
+    """
+    W = barrier * np.exp(-(xi - 1) ** 2 / (2 * width ** 2))
+    dW = -W * (xi - 1) / width ** 2
+    d2W = W * ((xi - 1) ** 2 / width ** 4 - 1 / width ** 2)
+    return W, dW, d2W
+
+
+def writeInput(root, T, xiList, kforce, dt, evolutionTime):
+    with open(os.path.join(root, 'input.py'), 'w') as f:
+        f.write('''import PES
+
+label = 'H + CH4 -> H2 + CH3'
+
+reactants(
+    atoms = ['H', 'C', 'H', 'H', 'H', 'H'],
+    reactant1Atoms = [1],
+    reactant2Atoms = [2, 3, 4, 5, 6],
+    Rinf = (30 * 0.52918, 'angstrom'),
+)
+
+transitionState(
+    geometry = (
+        [[-4.68413503, -0.43825460, -0.07250839],
+         [-2.24759387, -0.19250865, -0.02535431],
+         [-0.28198117, -0.00164857, 0.00918984],
+         [0.11945044, 1.32063931, -1.54233470],
+         [0.17986809, 0.83914568, 1.83094436],
+         [0.21443422, -1.89975096, -0.20039883]],
+        'bohr',
+    ),
+    formingBonds = [(1, 2)],
+    breakingBonds = [(2, 3)],
+)
+
+equivalentTransitionState(
+    formingBonds = [(1, 4)],
+    breakingBonds = [(4, 3)],
+)
+
+thermostat('Andersen')
+
+xi_list = numpy.linspace({xiMin!r}, {xiMax!r}, {windows})
+
+generateUmbrellaConfigurations(
+    dt = ({dt!r}, 'ps'),
+    evolutionTime = (5, 'ps'),
+    xi_list = xi_list,
+    kforce = {kforce!r} * T,
+)
+
+windows = []
+for xi in numpy.linspace({xiMin!r}, {xiMax!r}, {windows}):
+    window = Window(xi=xi, kforce={kforce!r} * T, trajectories=200, equilibrationTime=(20, 'ps'),
+                    evolutionTime=({evolutionTime!r}, 'ps'))
+    windows.append(window)
+
+conductUmbrellaSampling(
+    dt = ({dt!r}, 'ps'),
+    windows = windows,
+)
+
+computePotentialOfMeanForce(windows=windows, xi_min={xiMin!r}, xi_max={xiMax!r}, bins=5000)
+
+computeRecrossingFactor(
+    dt = ({dt!r}, 'ps'),
+    equilibrationTime = (20, 'ps'),
+    childTrajectories = 100000,
+    childSamplingTime = (2, 'ps'),
+    childrenPerSampling = 100,
+    childEvolutionTime = (0.05, 'ps'),
+)
+
+computeRateCoefficient()
+'''.format(xiMin=float(xiList[0]), xiMax=float(xiList[-1]), windows=len(xiList), dt=dt, kforce=kforce / T,
+           evolutionTime=evolutionTime))
+
+
+def writeUmbrella(fname, xi, T, Nbeads, kforce, dt, evolutionTime, cycles, samples, barrier, width, rng):
+    """
+    The umbrella sampling file of the window at `xi`: 15 info lines, the time step on line 10,
+    then one line `sum(xi) sum(xi^2) steps mean variance` per cycle, accumulated over the cycles.
+    """
+    beta = 1 / (kB * T)
+    W, dW, d2W = modelPMF(xi, barrier, width)
+    # Gaussian approximation of the biased distribution exp(-beta * (W + kforce / 2 * (x - xi)^2))
+    curvature = max(kforce + d2W, 0.1 * kforce)
+    mean = xi - dW / curvature
+    var = 1 / (beta * curvature)
+    steps = int(round(evolutionTime / dt))
+
+    blockMean = mean + np.sqrt(var / samples) * rng.standard_normal(cycles)
+    blockVar = var * rng.chisquare(samples - 1, cycles) / (samples - 1)
+    count = steps * np.arange(1, cycles + 1)
+    av = np.cumsum(blockMean * steps)
+    av2 = np.cumsum((blockVar + blockMean ** 2) * steps)
+
+    with open(fname, 'w') as f:
+        f.write('# Umbrella sampling (synthetic)\n')
+        f.write('#\n')
+        f.write('# Temperature       = {} K\n'.format(T))
+        f.write('# Number of beads   = {}\n'.format(Nbeads))
+        f.write('# Reaction coord.   = {:.8f}\n'.format(xi))
+        f.write('# Force constant    = {:.6f}\n'.format(kforce))
+        f.write('# Trajectories      = {}\n'.format(cycles))
+        f.write('# Equilibration     = 20 ps\n')
+        f.write('# Evolution time    = {} ps\n'.format(evolutionTime))
+        f.write('# Time step = {} ps\n'.format(dt))
+        f.write('#\n')
+        f.write('# Columns: cumulative sum of xi, cumulative sum of xi^2, number of steps,\n')
+        f.write('#          mean of xi, variance of xi\n')
+        f.write('#\n')
+        f.write('# =====================================================================\n')
+        for line in zip(av, av2, count, av / count, av2 / count - (av / count) ** 2):
+            f.write('{:.12e} {:.12e} {:d} {:.12e} {:.12e}\n'.format(*line))
+
+
+def writePMF(fname, xiMin, xiMax, barrier, width):
+    xi = np.linspace(xiMin, xiMax, 5000)
+    W = modelPMF(xi, barrier, width)[0]
+    with open(fname, 'w') as f:
+        f.write('# Potential of mean force (synthetic)\n')
+        f.write('#\n' * 10)
+        f.write('# xi                W(xi) (eV)\n')
+        for x, w in zip(xi, W * hartree2eV):
+            f.write('{:18.8f} {:18.10e}\n'.format(x, w))
+        f.write('# end\n')
+
+
+def writeRecrossing(fname, kappa, rng):
+    t = np.linspace(0, 50, 501)  # fs
+    k = kappa + (1 - kappa) * np.exp(-t / 5) + 0.005 * rng.standard_normal(len(t)) * np.sqrt(t / 50)
+    with open(fname, 'w') as f:
+        f.write('# Recrossing factor (synthetic)\n')
+        f.write('#\n' * 15)
+        f.write('# t (fs)          kappa(t)\n')
+        for line in zip(t, k):
+            f.write('{:12.4f} {:14.8f}\n'.format(*line))
+        f.write('# end\n')
+
+
+def writeRate(fname, T, barrier, kappa):
+    prob = np.exp(-barrier / (kB * T))
+    kQTST = 1.0e-10 * prob * 1e6  # cm^3/(molecule*s), order of magnitude only
+    lines = ['# Rate coefficient (synthetic)', '#', '', '',
+             'Temperature                     = {} K'.format(T),
+             '', '', '', '', '',
+             'Prob. at the barrier           = {:.6e}'.format(prob),
+             '',
+             'xi^ddagger                      = {:.6f}'.format(1.0),
+             '',
+             'k_QTST                          = {:.6e} cm^3/(molecule*s)'.format(kQTST),
+             '', '',
+             'Transmission coefficient        = {:.6f}'.format(kappa),
+             '',
+             'k_RPMD                          = {:.6e} cm^3/(molecule*s)'.format(kQTST * kappa),
+             '']
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def generate(root, T=300, Nbeads=4, windows=110, cycles=100, ragged=2, samples=400, xiMin=-0.05, xiMax=1.05,
+             barrier=10.0, width=0.15, kforce=0.1, dt=0.0001, evolutionTime=100, kappa=0.6, seed=0):
+    """
+    Write the synthetic task into `root`, see the module docstring.
+    `barrier` is in kcal/mol, `kforce` in units of T as in RPMDrate input files, `dt` and `evolutionTime` in ps.
+    The windows have between `cycles - ragged` and `cycles` cycles.
+    Return the folder of the umbrella sampling files.
+    """
+    rng = np.random.default_rng(seed)
+    path = os.path.join(root, str(T), str(Nbeads))
+    os.makedirs(path, exist_ok=True)
+
+    xiList = np.linspace(xiMin, xiMax, windows)
+    writeInput(root, T, xiList, kforce * T, dt, evolutionTime)
+    barrier /= hartree2kcal
+    for i, xi in enumerate(xiList):
+        xi = float('{0:.8f}'.format(xi))
+        fname = os.path.join(path, 'umbrella_sampling_{0:.8f}.dat'.format(xi))
+        writeUmbrella(fname, xi, T, Nbeads, kforce * T, dt, evolutionTime,
+                      cycles - (i % (ragged + 1) if ragged > 0 else 0), samples, barrier, width, rng)
+    writePMF(os.path.join(path, 'potential_of_mean_force.dat'), xiMin, xiMax, barrier, width)
+    writeRecrossing(os.path.join(path, 'recrossing_factor_{:.2f}.dat'.format(1.0)), kappa, rng)
+    writeRate(os.path.join(path, 'rate_{}K.dat'.format(T)), T, barrier, kappa)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write a synthetic RPMDrate task')
+    parser.add_argument('root', help='folder of the task, input.py goes here and the data into root/T/Nbeads')
+    parser.add_argument('-t', '--t', help='temperature', dest='T', type=int, default=300)
+    parser.add_argument('-n', '--n', help='number of beads', dest='N', type=int, default=4)
+    parser.add_argument('--windows', help='number of umbrella windows', type=int, default=110)
+    parser.add_argument('--cycles', help='number of cycles (lines) of the longest windows', type=int, default=100)
+    parser.add_argument('--ragged', help='the windows have up to this number of cycles less', type=int, default=2)
+    parser.add_argument('--samples', help='independent samples per cycle, the noise is 1/sqrt(samples)', type=int,
+                        default=400)
+    parser.add_argument('--barrier', help='height of the model barrier (kcal/mol)', type=float, default=10.0)
+    parser.add_argument('--seed', help='seed of the random numbers', type=int, default=0)
+    args = parser.parse_args()
+
+    path = generate(args.root, args.T, args.N, args.windows, args.cycles, args.ragged, args.samples,
+                    barrier=args.barrier, seed=args.seed)
+    print('[INFO] {} windows of {} cycles written into {}'.format(args.windows, args.cycles, path))
+
+
+if __name__ == '__main__':
+    main()
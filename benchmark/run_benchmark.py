@@ -0,0 +1,137 @@
+'''
+Time Post-RPMDrate on synthetic tasks of several scales (see generate_dataset.py).
+Each task is processed twice with `--profile`: a cold run parsing every umbrella file (`--no-cache`)
+and a warm run reading them from the cache. The loading, PMF evolution, overlap and rendering times are taken from
+`profile.json`, and the total time from the wall clock, so that any version of the script can be compared.
+The results are printed as a table and saved into `benchmark_results.json`.
+[Usage]
+run `python run_benchmark.py --scales small,medium` (see `-h` for the other parameters)
+To compare two versions, run it with `--script` pointing to each of them and `--dir` to reuse the same datasets.
+'''
+import argparse
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+
+from generate_dataset import generate
+
+here = os.path.dirname(os.path.abspath(__file__))
+scales = {  # windows, cycles
+    'small': (30, 20),
+    'medium': (110, 100),
+    'large': (220, 400),
+}
+
+
+def prepareDataset(folder, windows, cycles):
+    """
+    Generate the dataset of `windows` x `cycles` into `folder`, unless it is already there.
+    """
+    stamp = os.path.join(folder, 'dataset.json')
+    if os.path.exists(stamp):
+        with open(stamp, 'r') as f:
+            if json.load(f) == [windows, cycles]:
+                return
+    generate(folder, windows=windows, cycles=cycles)
+    with open(stamp, 'w') as f:
+        json.dump([windows, cycles], f)
+
+
+def runScript(script, folder, options, log):
+    """
+    Run the script on the task in `folder` and return the wall time and the stages of its profile (None if the
+    script does not support `--profile`).
+    """
+    profile = os.path.join(folder, '300_4', 'profile.json')
+    if os.path.exists(profile):
+        os.remove(profile)
+    command = [sys.executable, script, '-t', '300', '-n', '4', '-R', './'] + options
+    start = time.perf_counter()
+    with open(log, 'w') as f:
+        subprocess.run(command, cwd=folder, stdout=f, stderr=subprocess.STDOUT, check=True)
+    wall = time.perf_counter() - start
+    if not os.path.exists(profile):
+        return wall, None
+    with open(profile, 'r') as f:
+        return wall, json.load(f)['stages']
+
+
+def summarize(wall, stages):
+    """
+    The times (s) of the benchmarked steps in a run.
+    """
+    result = {'total': wall}
+    if stages is None:
+        return result
+
+    def stageTime(*names):
+        return sum(stage['wall'] for stage in stages if stage['stage'].split('(')[0] in names)
+
+    result['loading'] = stageTime('getUmbrellaInfo')
+    result['PMF evolution'] = stageTime('computePMFEvolution')
+    result['overlap'] = stageTime('plot_overlap', 'plot_overlap_evolution')
+    result['rendering'] = sum(stage['savefig_wall'] for stage in stages)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time Post-RPMDrate on synthetic tasks')
+    parser.add_argument('--scales', help='comma separated scales among ' + ', '.join(scales), default='small,medium')
+    parser.add_argument('--script', help='the version of the script to time',
+                        default=os.path.join(here, '..', 'Post-RPMDrate_(single_task).py'))
+    parser.add_argument('--dir', help='folder of the datasets, kept between runs', default=os.path.join(here, 'data'))
+    parser.add_argument('--repeat', help='number of runs of each kind, the fastest one is kept', type=int, default=1)
+    parser.add_argument('--options', help='extra options of the script, e.g. "-j 4 --frames log:10"', default='')
+    args = parser.parse_args()
+
+    with open(args.script, 'r') as f:
+        supported = f.read()
+    profiled = '--profile' in supported
+    options = shlex.split(args.options) + (['--profile'] if profiled else [])
+    if '--upload' in supported:  # never push the synthetic tasks into the bucket
+        options += ['--upload', 'none']
+    if not profiled:
+        print('[WARNING] {} has no `--profile`, only the total time is measured. '.format(args.script))
+
+    results = {}
+    for scale in args.scales.split(','):
+        windows, cycles = scales[scale]
+        folder = os.path.join(args.dir, scale)
+        print('[INFO] {}: {} windows x {} cycles'.format(scale, windows, cycles))
+        prepareDataset(folder, windows, cycles)
+
+        for kind, extra in (('cold', ['--no-cache'] if '--no-cache' in supported else []), ('warm', [])):
+            if kind == 'warm':  # fill the cache
+                runScript(args.script, folder, options, os.path.join(folder, 'log.txt'))
+            runs = [summarize(*runScript(args.script, folder, options + extra, os.path.join(folder, 'log.txt')))
+                    for _ in range(args.repeat)]
+            results[scale, kind] = {step: min(run[step] for run in runs) for step in runs[0]}
+            print('       {} run: {:.1f} s'.format(kind, results[scale, kind]['total']))
+
+    steps = ['total', 'loading', 'PMF evolution', 'overlap', 'rendering']
+    print('[INFO] Benchmark (seconds): ')
+    print('       {:<8s}{:<6s}'.format('scale', 'run') + ''.join('{:>15s}'.format(step) for step in steps))
+    for (scale, kind), result in results.items():
+        print('       {:<8s}{:<6s}'.format(scale, kind) +
+              ''.join('{:>15.2f}'.format(result[step]) if step in result else '{:>15s}'.format('-') for step in steps))
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(args.script),
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    fname = os.path.join(args.dir, 'benchmark_results.json')
+    with open(fname, 'w') as f:
+        json.dump({'script': os.path.abspath(args.script), 'commit': commit, 'options': args.options,
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                   'results': [{'scale': scale, 'windows': scales[scale][0], 'cycles': scales[scale][1], 'run': kind,
+                                **result} for (scale, kind), result in results.items()]}, f, indent=1)
+    print('[INFO] Results saved into {}'.format(fname))
+
+
+if __name__ == '__main__':
+    main()